@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import importlib
+import subprocess
+import tracemalloc
+from io import BytesIO
+from tempfile import mkdtemp
+from contextlib import contextmanager
+
+PHASES = ['export', 'stream_export', 'http_export', 'import', 'reimport', 'http_import']
+
+# Statements each phase may issue per challenge for --check-queries. Importing inserts every challenge on its own
+# because its generated id is needed for its flags, hints, tags and files, everything else is batched. A streamed
+# export issues a handful of statements for every batch of 500 challenges.
+QUERY_BUDGETS = {'export': 0, 'stream_export': 0.02, 'http_export': 0, 'import': 1, 'reimport': 0, 'http_import': 1}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark exporting and importing a synthetic set of challenges with a throwaway SQLite CTFd database')
+    parser.add_argument('--app-root', dest='app_root', type=str, help="app_root directory for the CTFd Flask app (default: 2 directories up from this script)", default=None)
+    parser.add_argument('-n', dest='challenges', type=int, help="number of challenges (default: 500)", default=500)
+    parser.add_argument('--flags', dest='flags', type=int, help="flags per challenge (default: 2)", default=2)
+    parser.add_argument('--hints', dest='hints', type=int, help="hints per challenge (default: 2)", default=2)
+    parser.add_argument('--tags', dest='tags', type=int, help="tags per challenge (default: 3)", default=3)
+    parser.add_argument('--prereqs', dest='prereqs', type=int, help="prerequisite edges per challenge (default: 1)", default=1)
+    parser.add_argument('--files', dest='files', type=int, help="attachments per challenge (default: 1)", default=1)
+    parser.add_argument('--file-size', dest='file_size', type=int, help="size of each attachment in bytes (default: 65536)", default=65536)
+    parser.add_argument('--description-size', dest='description_size', type=int, help="length of each description in characters (default: 2000)", default=2000)
+    parser.add_argument('--repeat', dest='repeat', type=int, help="number of times to run every phase, the fastest run is reported (default: 1)", default=1)
+    parser.add_argument('--seed', dest='seed', type=int, help="seed for the synthetic data (default: 0)", default=0)
+    parser.add_argument('-o', dest='out_file', type=str, help="name of the JSON results file (default: benchmark.json)", default="benchmark.json")
+    parser.add_argument('--compare', dest='compare', type=str, help="JSON results of an earlier run, exit with an error if any phase regressed", default=None)
+    parser.add_argument('--tolerance', dest='tolerance', type=float, help="fraction a measurement may grow over the '--compare' results before it counts as a regression (default: 0.2)", default=0.2)
+    parser.add_argument('--keep', dest='keep', help="if present, keep the temporary directory with the database, uploads and archives", action='store_true')
+    parser.add_argument('--memory', dest='memory', help="if present, run every phase once more with tracemalloc to measure the peak of the memory allocated by Python and where it was allocated, and trace the vendored YAML loaders (the times of these runs are not reported)", action='store_true')
+    parser.add_argument('--check-queries', dest='check_queries', help="if present, also run every phase with 10 times the challenges and exit with an error if any phase issued more extra SQL statements than its budget per challenge allows", action='store_true')
+    parser.add_argument('--query-slack', dest='query_slack', type=int, help="constant number of extra statements '--check-queries' tolerates (default: 10)", default=10)
+    return parser.parse_args()
+
+
+def setup_paths(args):
+    plugin_dir = os.path.dirname(os.path.abspath(__file__))
+    if args.app_root:
+        app_root = os.path.abspath(args.app_root)
+    else:
+        app_root = os.path.dirname(os.path.dirname(plugin_dir))
+    sys.path.append(os.path.dirname(app_root)) # Enable imports of CTFd modules
+    return 'CTFd.plugins.' + os.path.basename(plugin_dir)
+
+
+def create_app(workdir):
+    from CTFd import create_app
+    from CTFd.config import TestingConfig
+
+    class BenchmarkConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(workdir, 'ctfd.db')
+        UPLOAD_FOLDER = os.path.join(workdir, 'uploads')
+
+    os.makedirs(BenchmarkConfig.UPLOAD_FOLDER)
+    app = create_app(BenchmarkConfig)
+
+    with app.app_context():
+        from CTFd.models import db, Admins
+        from CTFd.utils import set_config
+
+        set_config('setup', True)
+        admin = Admins(name='admin', email='admin@example.com', password='password')
+        db.session.add(admin)
+        db.session.commit()
+        app.config['BENCHMARK_ADMIN'] = admin.id
+
+    return app
+
+
+def seed(app, args, challenges):
+    from CTFd.models import db, Challenges, Flags, Hints, Tags, ChallengeFiles
+
+    rnd = random.Random(args.seed)
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod',
+             'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', 'flag:', '<b>', '#']
+
+    def text(length):
+        out = []
+        size = 0
+        while size < length:
+            word = rnd.choice(words)
+            out.append(word)
+            size += len(word) + 1
+        return ' '.join(out)[:length]
+
+    upload_folder = app.config['UPLOAD_FOLDER']
+    chals = []
+    for i in range(challenges):
+        chal = Challenges(
+            name='challenge {}'.format(i),
+            description=text(args.description_size),
+            value=rnd.randint(1, 50) * 10,
+            category='category {}'.format(i % 10),
+            type='standard',
+        )
+        chal.state = 'hidden' if i % 10 == 0 else 'visible'
+        chal.max_attempts = i % 5
+        chals.append(chal)
+    db.session.add_all(chals)
+    db.session.flush()
+
+    for i, chal in enumerate(chals):
+        for j in range(args.flags):
+            db.session.add(Flags(challenge_id=chal.id, content='flag{{{}_{}}}'.format(i, j), type='static', data=''))
+        for j in range(args.hints):
+            db.session.add(Hints(challenge_id=chal.id, content=text(100), type='standard', cost=j * 10))
+        for j in range(args.tags):
+            db.session.add(Tags(challenge_id=chal.id, value='tag{}'.format(rnd.randint(0, 50))))
+        for j in range(args.files):
+            dirname = hashlib.md5('{}-{}'.format(i, j).encode('utf-8')).hexdigest()
+            os.makedirs(os.path.join(upload_folder, dirname))
+            location = os.path.join(dirname, 'file{}.bin'.format(j))
+            with open(os.path.join(upload_folder, location), 'wb') as f:
+                f.write(rnd.randbytes(args.file_size))
+            db.session.add(ChallengeFiles(challenge_id=chal.id, location=location))
+        if i and args.prereqs:
+            prereqs = rnd.sample(chals[:i], min(i, args.prereqs))
+            chal.requirements = {'prerequisites': [req.id for req in prereqs]}
+
+    db.session.commit()
+
+
+def clear_challenges(app):
+    from CTFd.models import db, Challenges, Flags, Hints, Tags, ChallengeFiles
+
+    for model in (Flags, Hints, Tags, ChallengeFiles, Challenges):
+        model.query.delete()
+    db.session.commit()
+    db.session.close()
+
+    upload_folder = app.config['UPLOAD_FOLDER']
+    shutil.rmtree(upload_folder)
+    os.makedirs(upload_folder)
+
+
+def directory_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(dirpath, filename))
+    return size
+
+
+def parse_server_timing(header):
+    timings = {}
+    for metric in header.split(','):
+        name, _, duration = metric.strip().partition(';dur=')
+        if name and duration and name not in ('total', 'db'):
+            timings[name] = float(duration) / 1000
+    return timings
+
+
+@contextmanager
+def measure(counter, tracker, result):
+    start = time.perf_counter()
+    try:
+        with tracker, counter:
+            yield result
+    finally:
+        result['wall_time'] = time.perf_counter() - start
+        result['queries'] = counter.statements
+        result['db_time'] = counter.time
+        memory = tracker.report()
+        result['peak_rss'] = memory['rss_peak']
+        result['rss_growth'] = memory['rss_growth']
+        if 'traced_peak' in memory:
+            result['traced_peak'] = memory['traced_peak']
+            result['allocations'] = memory['allocations']
+
+
+def run_phase(phase, app, client, plugin, workdir, trace=False):
+    from CTFd.models import db
+
+    exporter = importlib.import_module(plugin + '.exporter')
+    importer = importlib.import_module(plugin + '.importer')
+    timing = importlib.import_module(plugin + '.timing')
+    querycounter = importlib.import_module(plugin + '.querycounter')
+    memory = importlib.import_module(plugin + '.memory')
+
+    def tracked():
+        return measure(querycounter.QueryCounter(db.engine), memory.MemoryTracker(trace=trace), result)
+
+    upload_folder = app.config['UPLOAD_FOLDER']
+    export_dir = os.path.join(workdir, 'export')
+    archive = os.path.join(workdir, 'export.tar.gz')
+    result = {}
+
+    if phase in ('export', 'stream_export'):
+        # The streamed export goes elsewhere, the import phases read the export of the first phase
+        if phase == 'stream_export':
+            export_dir = os.path.join(workdir, 'stream_export')
+        shutil.rmtree(export_dir, ignore_errors=True)
+        os.makedirs(export_dir)
+        out_file = os.path.join(export_dir, 'export.yaml')
+        with tracked(), timing.TransferTimer('Export') as timer:
+            with open(out_file, 'w') as out_stream:
+                out_stream.write(exporter.export_challenges(out_file=out_file, dst_attachments=os.path.join(export_dir, 'export.d'), src_attachments=upload_folder, visible_only=False, remove_flags=False, stream=phase == 'stream_export'))
+        result['timings'] = timer.totals
+        result['bytes_written'] = directory_size(export_dir)
+
+    elif phase == 'http_export':
+        with tracked():
+            response = client.get('/admin/yaml?timing=1')
+            data = response.get_data()
+        if response.status_code != 200:
+            raise RuntimeError("GET /admin/yaml failed with status {}".format(response.status_code))
+        result['timings'] = parse_server_timing(response.headers.get('Server-Timing', ''))
+        with open(archive, 'wb') as f:
+            f.write(data)
+        result['bytes_written'] = len(data)
+
+    elif phase in ('import', 'reimport'):
+        if phase == 'import':
+            clear_challenges(app)
+        with tracked(), timing.TransferTimer('Import') as timer:
+            importer.import_challenges(os.path.join(export_dir, 'export.yaml'), upload_folder, exit_on_error=True)
+        result['timings'] = timer.totals
+        result['bytes_written'] = directory_size(upload_folder)
+
+    elif phase == 'http_import':
+        clear_challenges(app)
+        with open(archive, 'rb') as f:
+            data = {'file': (BytesIO(f.read()), 'export.tar.gz'), 'nonce': 'benchmark'}
+        with tracked():
+            response = client.post('/admin/yaml?timing=1', data=data, content_type='multipart/form-data')
+        if response.status_code != 200:
+            raise RuntimeError("POST /admin/yaml failed with status {}".format(response.status_code))
+        result['timings'] = parse_server_timing(response.headers.get('Server-Timing', ''))
+        result['bytes_written'] = directory_size(upload_folder)
+
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for phase, result in results['phases'].items():
+        if phase not in baseline['phases']:
+            continue
+        for key in ('wall_time', 'queries', 'peak_rss', 'traced_peak', 'bytes_written'):
+            before = baseline['phases'][phase].get(key)
+            after = result.get(key)
+            if before is None or after is None:
+                continue
+            if after > before * (1 + tolerance):
+                regressions.append("{} {}: {} -> {}".format(phase, key, before, after))
+    return regressions
+
+
+def traced(function):
+    # Peak of the memory allocated while function runs, and the number of memory blocks still held by what it returns
+    tracemalloc.start()
+    try:
+        result = function()
+        blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak, blocks
+
+
+def run_yaml(plugin, path, repeat, required, memory=False):
+    # Times writing the exported challenges with every YAML writer available and reading them back with every loader,
+    # the fastest of repeat runs. With memory, also traces the memory used by the vendored loaders.
+    yamlbackend = importlib.import_module(plugin + '.yamlbackend')
+    fastyaml = importlib.import_module(plugin + '.fastyaml')
+    yaml = yamlbackend.yaml
+
+    with open(path, 'r') as in_stream:
+        text = in_stream.read()
+    documents = list(yaml.load_all(text, Loader=yamlbackend.Loader))
+
+    writers = {'python': lambda document: yaml.dump(document, Dumper=yaml.SafeDumper, **yamlbackend.DUMP_OPTIONS)}
+    loaders = {'python': lambda: list(yaml.load_all(text, Loader=yaml.SafeLoader)),
+               'fast python': lambda: list(fastyaml.load_challenges(text, required, loader=yaml.SafeLoader))}
+    if getattr(yaml, '__with_libyaml__', False):
+        writers['libyaml'] = lambda document: yaml.dump(document, Dumper=yaml.CSafeDumper, **yamlbackend.DUMP_OPTIONS)
+        loaders['libyaml'] = lambda: list(yaml.load_all(text, Loader=yaml.CSafeLoader))
+        loaders['fast libyaml'] = lambda: list(fastyaml.load_challenges(text, required, loader=yaml.CSafeLoader))
+    loaders['fast parallel'] = lambda: list(fastyaml.load_challenges_parallel(text, required))
+    writers['fast'] = fastyaml.dump_challenge
+
+    # The copy of PyYAML in lib/ is only used when PyYAML is not installed, time it anyway
+    vendored = importlib.import_module(plugin + '.lib.yaml')
+    unmarked = fastyaml._unmarked(vendored.SafeLoader)
+    alias_free = yamlbackend.alias_free(vendored.SafeDumper)
+    if vendored is not yaml:
+        writers['vendored'] = lambda document: vendored.dump(document, Dumper=vendored.SafeDumper, **yamlbackend.DUMP_OPTIONS)
+        loaders['vendored'] = lambda: list(vendored.load_all(text, Loader=vendored.SafeLoader))
+    writers['vendored no aliases'] = lambda document: vendored.dump(document, Dumper=alias_free, **yamlbackend.DUMP_OPTIONS)
+    loaders['vendored no marks'] = lambda: list(vendored.load_all(text, Loader=unmarked))
+
+    def best(function):
+        times = []
+        for run in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    results = {'dump': {}, 'load': {}}
+    for name, writer in writers.items():
+        results['dump'][name] = best(lambda: [writer(document) for document in documents])
+        print("{:<23} {:>8.3f}s".format('dump ' + name, results['dump'][name]))
+    for name, loader in loaders.items():
+        results['load'][name] = best(loader)
+        print("{:<23} {:>8.3f}s".format('load ' + name, results['load'][name]))
+
+    if memory:
+        # Tokens and events are dropped as soon as they are parsed, composed trees of nodes are held with their marks
+        results['memory'] = {}
+        for name, loader in (('vendored', vendored.SafeLoader), ('vendored no marks', unmarked)):
+            peak = traced(lambda: list(vendored.load_all(text, Loader=loader)))[0]
+            blocks = traced(lambda: list(vendored.compose_all(text, Loader=loader)))[1]
+            results['memory'][name] = {'traced_peak': peak, 'node_blocks': blocks}
+            print("{:<23} {:>8.1f} MiB peak {:>9} blocks held by nodes".format('load ' + name, peak / 2.0 ** 20, blocks))
+    return results
+
+
+def run(args, plugin, challenges, yaml=None):
+    workdir = mkdtemp(prefix='ctfd-portable-benchmark-')
+    phases = {}
+    try:
+        app = create_app(workdir)
+
+        with app.app_context():
+            print("Seeding {} challenges".format(challenges))
+            seed(app, args, challenges)
+
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess['id'] = app.config['BENCHMARK_ADMIN']
+                sess['nonce'] = 'benchmark'
+
+            for run in range(args.repeat):
+                for phase in PHASES:
+                    result = run_phase(phase, app, client, plugin, workdir)
+                    best = phases.get(phase)
+                    if best is None or result['wall_time'] < best['wall_time']:
+                        phases[phase] = result
+                    print("{:<13} {:>8.3f}s {:>7} queries {:>8.1f} MiB peak RSS".format(phase, result['wall_time'], result['queries'], result['peak_rss'] / 2.0 ** 20))
+
+            if args.memory:
+                # Tracing slows everything down, so the traced runs are separate from the timed ones
+                for phase in PHASES:
+                    result = run_phase(phase, app, client, plugin, workdir, trace=True)
+                    phases[phase]['traced_peak'] = result['traced_peak']
+                    phases[phase]['allocations'] = result['allocations']
+                    print("{:<13} {:>8.1f} MiB peak traced allocations".format(phase, result['traced_peak'] / 2.0 ** 20))
+
+            if yaml is not None:
+                required = importlib.import_module(plugin + '.importer').REQ_FIELDS
+                yaml.update(run_yaml(plugin, os.path.join(workdir, 'export', 'export.yaml'), args.repeat, required, args.memory))
+    finally:
+        if args.keep:
+            print("Keeping {}".format(workdir))
+        else:
+            shutil.rmtree(workdir)
+
+    return phases
+
+
+def check_queries(small, large, extra_challenges, slack):
+    failures = []
+    for phase, budget in QUERY_BUDGETS.items():
+        extra = large[phase]['queries'] - small[phase]['queries']
+        allowed = budget * extra_challenges + slack
+        if extra > allowed:
+            failures.append("{}: {} -> {} statements, at most {} more allowed".format(phase, small[phase]['queries'], large[phase]['queries'], allowed))
+    return failures
+
+
+def main():
+    args = parse_args()
+    plugin = setup_paths(args)
+
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'params': {key: getattr(args, key) for key in ('challenges', 'flags', 'hints', 'tags', 'prereqs', 'files', 'file_size', 'description_size', 'repeat', 'seed', 'memory')},
+        'yaml_backend': importlib.import_module(plugin + '.fastyaml').describe(),
+        'yaml': {},
+    }
+    results['phases'] = run(args, plugin, args.challenges, results['yaml'])
+
+    with open(args.out_file, 'w') as out_stream:
+        json.dump(results, out_stream, indent=2)
+
+    failed = False
+    if args.check_queries:
+        large = run(args, plugin, args.challenges * 10)
+        failures = check_queries(results['phases'], large, args.challenges * 9, args.query_slack)
+        for failure in failures:
+            print("Query count grows with the challenges:", failure)
+        failed = failed or bool(failures)
+
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("Regression:", regression)
+        failed = failed or bool(regressions)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import importlib
+
+# Handlers for the challenge types which keep columns of their own in a separate table, keyed by type name. Other
+# types are transferred with just the columns of the Challenges table.
+HANDLERS = {}
+
+
+class ChallengeType(object):
+    # Maps the columns a challenge type adds to the Challenges table to the fields of the YAML file and back. The model
+    # is imported the first time it is needed, so the plugin providing it only has to be installed when challenges of
+    # that type are transferred, and an ImportError is raised otherwise.
+    def __init__(self, name):
+        self.name = name
+        self._model = None
+
+    def load_model(self):
+        from CTFd.models import Challenges
+        return Challenges
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = self.load_model()
+        return self._model
+
+    def load_rows(self, chal_ids=None):
+        # Rows of the type specific table keyed by challenge id, with one query for every challenge of the type (or
+        # those in chal_ids)
+        from CTFd.models import Challenges
+
+        model = self.model
+        if model is Challenges:
+            return {}
+        query = model.query
+        if chal_ids is not None:
+            query = query.filter(model.id.in_(chal_ids))
+        return {row.id: row for row in query.all()}
+
+    def export_fields(self, row):
+        return {}
+
+    def import_fields(self, chal):
+        # Attributes which only exist on the DB model of the type
+        return {}
+
+
+class DynamicChallengeType(ChallengeType):
+    def load_model(self):
+        from CTFd.plugins.dynamic_challenges import DynamicChallenge
+        return DynamicChallenge
+
+    def export_fields(self, row):
+        return {'initial': row.initial, 'decay': row.decay, 'minimum': row.minimum}
+
+    def import_fields(self, chal):
+        initial = int(chal['value'])
+        if 'initial' in chal:
+            initial = int(chal['initial'])
+
+        minimum = 0
+        if 'minimum' in chal:
+            minimum = int(chal['minimum'])
+
+        decay = 0
+        if 'decay' in chal:
+            decay = int(chal['decay'])
+
+        return {'initial': initial, 'decay': decay, 'minimum': minimum}
+
+
+class NaumachiaChallengeType(ChallengeType):
+    def load_model(self):
+        # Here we use a fixed name, which is the repository name, even though it does
+        # not conform to a proper Python package name. Users may install the package
+        # using any file name they want, but this version of this plugin does not
+        # support it.
+        naumachia_plugin = importlib.import_module('.ctfd-naumachia-plugin', package="CTFd.plugins")
+        return naumachia_plugin.NaumachiaChallengeModel
+
+    def export_fields(self, row):
+        return {'naumachia_name': row.naumachia_name}
+
+    def import_fields(self, chal):
+        return {'naumachia_name': chal.get('naumachia_name', "").strip()}
+
+
+def register(handler):
+    HANDLERS[handler.name] = handler
+    return handler
+
+
+def handler(chal_type):
+    # The registered handler of a type, or one which treats it like a standard challenge
+    if chal_type not in HANDLERS:
+        return ChallengeType(chal_type)
+    return HANDLERS[chal_type]
+
+
+register(DynamicChallengeType('dynamic'))
+register(NaumachiaChallengeType('naumachia'))
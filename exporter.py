@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 
-import importlib
 import os
 import sys
 from flask import Flask
@@ -14,13 +13,35 @@ from tempfile import TemporaryFile
 import shutil
 import argparse
 import gzip
-from sqlalchemy.sql import column
+import hashlib
+import json
+import time
+import logging
+from io import BytesIO
 
-# Try to load PyYAMP if it's installed, if not load the local version
 try:
-    import yaml
-except ModuleNotFoundError:
-    from .lib import yaml
+    from .timing import TransferTimer, phase
+    from .querycounter import QueryCounter
+    from .profiling import TransferProfiler
+    from .metrics import CHALLENGES
+    from .memory import MemoryTracker
+    from .pipeline import Stage
+    from . import yamlbackend, fastyaml, challengetypes
+except ImportError:
+    from timing import TransferTimer, phase
+    from querycounter import QueryCounter
+    from profiling import TransferProfiler
+    from metrics import CHALLENGES
+    from memory import MemoryTracker
+    from pipeline import Stage
+    import yamlbackend
+    import fastyaml
+    import challengetypes
+
+logger = logging.getLogger(__name__)
+
+# Challenges loaded at a time by --stream
+STREAM_BATCH_SIZE = 500
 
 
 def parse_args():
@@ -34,6 +55,13 @@ def parse_args():
     parser.add_argument('--gz', dest='gz', help="if present, compress the tar file (only used if '--tar' is on)", action='store_true')
     parser.add_argument('--visible-only', dest='visible_only', help="if present, ignore hidden challenges", action='store_true')
     parser.add_argument('--remove-flags', dest='remove_flags', help="if present, replace flags with a placeholder", action='store_true')
+    parser.add_argument('-v', '--verbose', dest='verbose', help="if present, also log the time taken by every challenge", action='store_true')
+    parser.add_argument('--profile', dest='profile', help="if present, run the export under cProfile and write the stats to [OUT_FILE].prof", action='store_true')
+    parser.add_argument('--memory', dest='memory', help="if present, report the peak memory use of the export and the lines which allocated the most (makes the export slower)", action='store_true')
+    parser.add_argument('--stream', dest='stream', help="if present, load the challenges %d at a time rather than all at once, so memory use does not grow with the number of challenges" % STREAM_BATCH_SIZE, action='store_true')
+    parser.add_argument('--manifest', dest='manifest', type=str, help="file to write the digests of the exported challenges and attachments to (default: the '--since-manifest' file)", default=None)
+    parser.add_argument('--since-manifest', dest='since_manifest', type=str, help="manifest of a previous export into the same location, only challenges and attachments which changed since then are written again", default=None)
+    parser.add_argument('--delta', dest='delta', type=str, help="if present, also write the YAML file, the manifest and the changed attachments to this gzipped tarball along with a list of deletions (only used if '--since-manifest' is on)", default=None)
     return parser.parse_args()
 
 
@@ -58,6 +86,104 @@ def process_args(args):
     return args
 
 
+def dump_challenge(properties):
+    if fastyaml.ENABLED:
+        try:
+            return fastyaml.dump_challenge(properties)
+        except fastyaml.Unsupported as e:
+            logger.debug("Writing challenge %s with the generic YAML dumper: unsupported %s", properties.get('name'), e)
+    return yamlbackend.dump(properties)
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    hasher = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class ExportManifest(object):
+    # Records a digest of every challenge and attachment an export wrote, along with where each challenge's document
+    # sits in the YAML file. Given the manifest of the previous export, unchanged challenges are copied out of the
+    # previous YAML file instead of being serialized again and unchanged attachments are not copied again.
+    def __init__(self, previous=None, previous_yaml=None):
+        self.previous = previous or {'challenges': {}, 'attachments': {}}
+        self.previous_yaml = previous_yaml
+        self.challenges = {}
+        self.attachments = {}
+        self.changed_challenges = []
+        self.changed_attachments = {}
+
+    @classmethod
+    def load(cls, path, yaml_path=None):
+        with open(path, 'r') as manifest_file:
+            previous = json.load(manifest_file)
+
+        previous_yaml = None
+        if yaml_path and os.path.exists(yaml_path):
+            with open(yaml_path, 'r') as yaml_file:
+                previous_yaml = yaml_file.read()
+
+        return cls(previous, previous_yaml)
+
+    def serialize(self, chal_id, properties, offset):
+        digest = hashlib.sha256(json.dumps(properties, default=str).encode('utf-8')).hexdigest()
+
+        document = None
+        previous = self.previous['challenges'].get(str(chal_id))
+        if previous and previous['digest'] == digest and self.previous_yaml is not None:
+            document = self.previous_yaml[previous['offset']:previous['offset'] + previous['length']]
+            # Make sure the previous file was not edited since it was written
+            if hashlib.sha256(document.encode('utf-8')).hexdigest() != previous['document']:
+                document = None
+
+        if document is None:
+            document = dump_challenge(properties)
+            self.changed_challenges.append(properties['name'])
+
+        self.challenges[str(chal_id)] = {
+            'name': properties['name'],
+            'digest': digest,
+            'document': hashlib.sha256(document.encode('utf-8')).hexdigest(),
+            'offset': offset,
+            'length': len(document),
+        }
+        return document
+
+    # Returns True if the attachment has to be written again. The source is only hashed if its size or modification
+    # time changed since the previous export.
+    def check_attachment(self, rel_path, src_path, dst_path=None):
+        stat = os.stat(src_path)
+        record = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+        previous = self.previous['attachments'].get(rel_path)
+        if previous and previous['size'] == record['size'] and previous['mtime'] == record['mtime']:
+            record['digest'] = previous['digest']
+        else:
+            with phase('hash'):
+                record['digest'] = file_digest(src_path)
+        self.attachments[rel_path] = record
+
+        changed = not (previous and previous['digest'] == record['digest'])
+        if dst_path is not None and not os.path.exists(dst_path):
+            changed = True
+
+        if changed:
+            self.changed_attachments[src_path] = rel_path
+        return changed
+
+    def deletions(self):
+        return {
+            'challenges': [chal['name'] for chal_id, chal in self.previous['challenges'].items() if chal_id not in self.challenges],
+            'attachments': [path for path in self.previous['attachments'] if path not in self.attachments],
+        }
+
+    def save(self, path):
+        with open(path, 'w') as manifest_file:
+            json.dump({'challenges': self.challenges, 'attachments': self.attachments}, manifest_file, indent=1, sort_keys=True)
+
+
 def copy_files(file_map):
     for src_path, dst_path in file_map.items():
         dst_dir = os.path.dirname(dst_path)
@@ -73,130 +199,215 @@ def tar_files(file_map, tarfile):
         tarfile.add(src_path, dst_path)
 
 
-def export_challenges(out_file, dst_attachments, src_attachments, visible_only, remove_flags, tarfile=None):
-    from CTFd.models import Challenges, Flags, Tags, Hints, ChallengeFiles
-
-    chals = Challenges.query.order_by(Challenges.value).all()
-    chals_list = []
-
-    for chal in chals:
-        if visible_only and (chal.state == 'hidden'):
-            continue
-
-        properties = {
-            'name': chal.name,
-            'value': chal.value,
-            'description': chal.description,
-            'category': chal.category,
-            'type': chal.type
-        }
-
-        flags_obj = Flags.query.filter_by(challenge_id=chal.id)
-        flags = []
-        for flag_obj in flags_obj:
-            flag = {'flag': flag_obj.content, 'type': flag_obj.type, 'data': str(flag_obj.data or '')}
-            flags.append(flag)
-        properties['flags'] = flags
-
-        if remove_flags:
-            properties['flags'] = [{'flag': 'removed', 'type': 'static', 'data': ''}]
+def load_challenge_rows(chal_ids=None):
+    from CTFd.models import Flags, Tags, Hints, ChallengeFiles
+
+    # One query per table for every challenge (or those in chal_ids) rather than a handful of queries for each challenge
+    rows = {}
+    for model in (Flags, Hints, Tags, ChallengeFiles):
+        rows[model] = {}
+        query = model.query
+        if chal_ids is not None:
+            query = query.filter(model.challenge_id.in_(chal_ids))
+        for row in query.order_by(model.id).all():
+            rows[model].setdefault(row.challenge_id, []).append(row)
+    return rows
+
+
+def stream_challenges(chal_ids, batch_size=STREAM_BATCH_SIZE):
+    # Loads the challenges in chal_ids, along with their rows, batch_size at a time and yields every batch as
+    # (challenges, rows, type_rows) in the order of chal_ids. Once the caller is done with a batch its objects are
+    # expunged from the session, so the session only ever holds one batch.
+    from CTFd.models import db, Challenges
+
+    for i in range(0, len(chal_ids), batch_size):
+        batch = chal_ids[i:i + batch_size]
+        with phase('query'):
+            chals = {chal.id: chal for chal in Challenges.query.filter(Challenges.id.in_(batch)).all()}
+            rows = load_challenge_rows(batch)
+            type_rows = {}
+            for chal_type in set(chal.type for chal in chals.values()):
+                try:
+                    type_rows[chal_type] = challengetypes.handler(chal_type).load_rows(batch)
+                except ImportError:
+                    # challenge_properties reports it when it comes across a challenge of the type
+                    pass
+
+        yield [chals[chal_id] for chal_id in batch if chal_id in chals], rows, type_rows
+
+        loaded = list(chals.values())
+        for model_rows in rows.values():
+            for chal_rows in model_rows.values():
+                loaded.extend(chal_rows)
+        for chal_type_rows in type_rows.values():
+            loaded.extend(chal_type_rows.values())
+        for obj in loaded:
+            if obj in db.session:
+                db.session.expunge(obj)
+
+
+def challenge_properties(chal, remove_flags, rows, type_rows, names):
+    from CTFd.models import Flags, Tags, Hints
+
+    properties = {
+        'name': chal.name,
+        'value': chal.value,
+        'description': chal.description,
+        'category': chal.category,
+        'type': chal.type
+    }
+
+    flags = []
+    for flag_obj in rows[Flags].get(chal.id, []):
+        flag = {'flag': flag_obj.content, 'type': flag_obj.type, 'data': str(flag_obj.data or '')}
+        flags.append(flag)
+    properties['flags'] = flags
+
+    if remove_flags:
+        properties['flags'] = [{'flag': 'removed', 'type': 'static', 'data': ''}]
+
+    hints = []
+    for hint_obj in rows[Hints].get(chal.id, []):
+        hint = {'hint': hint_obj.content, 'type': hint_obj.type, 'cost': hint_obj.cost}
+        hints.append(hint)
+    properties['hints'] = hints
+
+    if chal.state:
+        properties['hidden'] = chal.state == 'hidden'
+
+    if chal.max_attempts:
+        properties['max_attempts'] = chal.max_attempts
+
+    tags = [tag.value for tag in rows[Tags].get(chal.id, [])]
+    if tags:
+        properties['tags'] = tags
+
+    if chal.type not in type_rows:
+        try:
+            type_rows[chal.type] = challengetypes.handler(chal.type).load_rows()
+        except ImportError as err:
+            logger.warning("Failed to import plugin for challenge type %s: %s", chal.type, err)
+            return None
+    type_obj = type_rows[chal.type].get(chal.id)
+    if type_obj is not None:
+        properties.update(challengetypes.handler(chal.type).export_fields(type_obj))
+
+    if chal.requirements and 'prerequisites' in chal.requirements:
+        reqs = []
+        for req in chal.requirements['prerequisites']:
+            req_name = names.get(int(req))
+            if req_name is None:
+                logger.warning("Failed to find challenge %s required by %s, skipping it", req, chal.name)
+                continue
+            reqs.append(req_name)
 
-        hints_obj = Hints.query.filter_by(challenge_id=chal.id)
-        hints = []
-        for hint_obj in hints_obj:
-            hint = {'hint': hint_obj.content, 'type': hint_obj.type, 'cost': hint_obj.cost}
-            hints.append(hint)
-        properties['hints'] = hints
+        if reqs:
+            properties['requirements'] = reqs
 
-        if chal.state:
-            properties['hidden'] = chal.state == 'hidden'
+    return properties
 
-        if chal.max_attempts:
-            properties['max_attempts'] = chal.max_attempts
 
-        try:
-            tags = [tag.value for tag in Tags.query.add_columns(column('value')).filter_by(challenge_id=chal.id).all()]
-        except:
-            # no tags are set
-            tags = None
-
-        if tags:
-            properties['tags'] = tags
-
-        if chal.type == 'dynamic':
-            # Lazy load the DynamicChallenge plugin on encountering a challenge of that type.
-            try:
-                from CTFd.plugins.dynamic_challenges import DynamicChallenge
-            except ImportError as err:
-                print("Failed to import plugin for challenge type {}: {}".format(chal.type, err))
-                continue
+def export_challenges(out_file, dst_attachments, src_attachments, visible_only, remove_flags, tarfile=None, manifest=None,
+                      stream=False):
+    from CTFd.models import db, Challenges, ChallengeFiles
 
-            dynamic_challenge_obj = DynamicChallenge.query.filter_by(id=chal.id).first()
-            properties['initial'] = dynamic_challenge_obj.initial
-            properties['decay'] = dynamic_challenge_obj.decay
-            properties['minimum'] = dynamic_challenge_obj.minimum
-
-        if chal.type == 'naumachia':
-            # Lazy load the Naumachia plugin on encountering a challenge of that type.
-            try:
-                # Here we use a fixed name, which is the repository name, even though it does
-                # not conform to a proper Python package name. Users may install the package
-                # using any file name they want, but this version of thsi plugin does not
-                # support it.
-                naumachia_plugin = importlib.import_module('.ctfd-naumachia-plugin', package="CTFd.plugins")
-            except ImportError as err:
-                print("Failed to import plugin for challenge type {}: {}".format(chal.type, err))
-                continue
-
-            dynamic_challenge_obj = naumachia_plugin.NaumachiaChallengeModel.query.filter_by(id=chal.id).first()
-            properties['naumachia_name'] = dynamic_challenge_obj.naumachia_name
+    with phase('query'):
+        if stream:
+            # Only the ids and names are loaded up front, the challenges themselves are loaded in batches
+            order = db.session.query(Challenges.id, Challenges.name).order_by(Challenges.value).all()
+            names = dict(order)
+            batches = stream_challenges([chal_id for chal_id, name in order])
+        else:
+            chals = Challenges.query.order_by(Challenges.value).all()
+            names = {chal.id: chal.name for chal in chals}
+            batches = [(chals, load_challenge_rows(), {})]
+    offset = 0
+
+    # The challenges are built from the database rows in this thread, while one thread serializes them and another
+    # copies their attachments, so a slow disk doesn't hold up the rest. Both take their work in order: the YAML
+    # documents are joined in the order of the challenges and a tar file is written by one thread at a time.
+    def serialize(item):
+        nonlocal offset
+        chal_id, properties, start = item
+        with phase('serialize'):
+            if manifest is not None:
+                document = manifest.serialize(chal_id, properties, offset)
+            else:
+                document = dump_challenge(properties)
+        CHALLENGES.inc('export', 'exported')
+        offset += len(document)
+        logger.debug("Exported %s in %.3fs", properties['name'], time.perf_counter() - start)
+        return document
+
+    def copy(item):
+        file_map, file_list = item
+        if tarfile:
+            if manifest is not None:
+                for (src_path, dst_path), rel_path in zip(file_map.items(), file_list):
+                    manifest.check_attachment(rel_path, src_path)
+            with phase('copy'):
+                tar_files(file_map, tarfile)
+        else:
+            if manifest is not None:
+                file_map = {src_path: dst_path for (src_path, dst_path), rel_path in zip(file_map.items(), file_list)
+                            if manifest.check_attachment(rel_path, src_path, dst_path)}
+            with phase('copy'):
+                copy_files(file_map)
 
-        if chal.requirements and 'prerequisites' in chal.requirements:
-            reqs = []
-            for req in chal.requirements['prerequisites']:
-                req_chal = Challenges.query.filter_by(id=int(req)).first()
-                if not req_chal:
-                    print("Failed to find challenge {} required by {}, skipping it".format(req, chal.name))
+    with Stage('export-serialize', serialize) as serializer, Stage('export-copy', copy) as copier:
+        for chals, rows, type_rows in batches:
+            for chal in chals:
+                if visible_only and (chal.state == 'hidden'):
                     continue
-                reqs.append(req_chal.name)
-
-            if reqs:
-                properties['requirements'] = reqs
 
+                start = time.perf_counter()
+                with phase('query'):
+                    properties = challenge_properties(chal, remove_flags, rows, type_rows, names)
+                    if properties is None:
+                        CHALLENGES.inc('export', 'skipped')
+                        continue
 
-        # These file locations will be partial paths in relation to the upload folder
-        src_paths_rel = [file.location for file in ChallengeFiles.query.add_columns(column('location')).filter_by(challenge_id=chal.id).all()]
+                # These file locations will be partial paths in relation to the upload folder
+                src_paths_rel = [file.location for file in rows[ChallengeFiles].get(chal.id, [])]
 
-        file_map = {}
-        file_list = []
-        for src_path_rel in src_paths_rel:
-            dirname, filename = os.path.split(src_path_rel)
-            dst_dir = os.path.join(dst_attachments, dirname)
-            src_path = os.path.join(src_attachments, src_path_rel)
-            file_map[src_path] = os.path.join(dst_dir, filename)
+                file_map = {}
+                file_list = []
+                for src_path_rel in src_paths_rel:
+                    dirname, filename = os.path.split(src_path_rel)
+                    dst_dir = os.path.join(dst_attachments, dirname)
+                    src_path = os.path.join(src_attachments, src_path_rel)
+                    file_map[src_path] = os.path.join(dst_dir, filename)
 
-            # Create path relative to the output file
-            dst_dir_rel = os.path.relpath(dst_dir, start=os.path.dirname(out_file))
-            file_list.append(os.path.join(dst_dir_rel, filename))
+                    # Create path relative to the output file
+                    dst_dir_rel = os.path.relpath(dst_dir, start=os.path.dirname(out_file))
+                    file_list.append(os.path.join(dst_dir_rel, filename))
 
-        if file_map:
-            properties['files'] = file_list
-            if tarfile:
-                tar_files(file_map, tarfile)
-            else:
-                copy_files(file_map)
+                if file_map:
+                    properties['files'] = file_list
+                    copier.put((file_map, file_list))
+                serializer.put((chal.id, properties, start))
 
-        print("Exporting", properties['name'])
-        chals_list.append(properties)
+        copier.join()
+        documents = serializer.join()
 
-    return yaml.safe_dump_all(chals_list, default_flow_style=False, allow_unicode=True, explicit_start=True, sort_keys=False)
+    return ''.join(documents)
 
 
 if __name__ == "__main__":
     args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(message)s')
+    logger.info("YAML backend: %s", fastyaml.describe())
 
     app = Flask(__name__)
 
+    # The previous YAML file has to be read before it is overwritten
+    manifest = None
+    manifest_file = args.manifest or args.since_manifest
+    if args.since_manifest and os.path.exists(args.since_manifest):
+        manifest = ExportManifest.load(args.since_manifest, None if args.tar else args.out_file)
+    elif manifest_file:
+        manifest = ExportManifest()
+
     tempfile = None
     tarfile = None
     out_stream = None
@@ -211,29 +422,65 @@ if __name__ == "__main__":
         out_stream = open(args.out_file, 'w')
 
 
-    with app.app_context():
-        args = process_args(args)
-        from CTFd.models import db
-
-        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-        db.init_app(app)
-
-        app.db = db
-
-        out_stream.write(export_challenges(out_file=args.out_file, dst_attachments=args.dst_attachments, src_attachments=args.src_attachments, visible_only=args.visible_only, remove_flags=args.remove_flags, tarfile=tarfile))
-
-    if args.tar:
-        print("Tarballing exported files")
-        tarinfo = TarInfo(args.out_file)
-        tarinfo.size = out_stream.tell()
-        out_stream.seek(0)
-        tarfile.addfile(tarinfo, out_stream)
-        tarfile.close()
-
-        if args.gz:
-            print("Compressing tarball with gzip")
-            with gzip.open('export.tar.gz', 'wb') as gz:
-                tempfile.seek(0)
-                shutil.copyfileobj(tempfile, gz)
-
-    out_stream.close()
+    profiler = TransferProfiler(args.out_file + '.prof', enabled=args.profile)
+    tracker = MemoryTracker(enabled=args.memory)
+    with TransferTimer('Export') as timer, profiler, tracker:
+        with app.app_context():
+            args = process_args(args)
+            from CTFd.models import db
+
+            app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+            db.init_app(app)
+
+            app.db = db
+
+            with QueryCounter(db.engine) as counter:
+                exported = export_challenges(out_file=args.out_file, dst_attachments=args.dst_attachments, src_attachments=args.src_attachments, visible_only=args.visible_only, remove_flags=args.remove_flags, tarfile=tarfile, manifest=manifest, stream=args.stream)
+            if args.tar:
+                exported = bytes(exported, "UTF-8")
+            out_stream.write(exported)
+
+        if args.tar:
+            logger.info("Tarballing exported files")
+            with phase('copy'):
+                tarinfo = TarInfo(args.out_file)
+                tarinfo.size = out_stream.tell()
+                out_stream.seek(0)
+                tarfile.addfile(tarinfo, out_stream)
+                tarfile.close()
+
+            if args.gz:
+                logger.info("Compressing tarball with gzip")
+                with phase('compress'):
+                    with gzip.open('export.tar.gz', 'wb') as gz:
+                        tempfile.seek(0)
+                        shutil.copyfileobj(tempfile, gz)
+
+        out_stream.close()
+
+    logger.info(timer.summary())
+    logger.info(counter.summary())
+    if profiler.active:
+        logger.info("Profile written to %s\n%s", profiler.stats_file, profiler.summary())
+    if tracker.enabled:
+        logger.info(tracker.summary())
+
+    if manifest is not None:
+        manifest.save(manifest_file)
+        deletions = manifest.deletions()
+        logger.info("%d challenges and %d attachments changed, %d challenges and %d attachments deleted",
+                    len(manifest.changed_challenges), len(manifest.changed_attachments),
+                    len(deletions['challenges']), len(deletions['attachments']))
+
+        if args.delta and not args.tar:
+            logger.info("Writing delta archive")
+            with TarFile.open(args.delta, 'w:gz') as delta:
+                delta.add(args.out_file, os.path.basename(args.out_file))
+                delta.add(manifest_file, os.path.basename(manifest_file))
+                for src_path, rel_path in manifest.changed_attachments.items():
+                    delta.add(src_path, rel_path)
+
+                deleted = bytes(json.dumps(deletions, indent=1), "UTF-8")
+                tarinfo = TarInfo('deleted.json')
+                tarinfo.size = len(deleted)
+                delta.addfile(tarinfo, BytesIO(deleted))
@@ -0,0 +1,495 @@
+import os
+import re
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from . import yamlbackend
+except ImportError:
+    import yamlbackend
+
+logger = logging.getLogger(__name__)
+
+# Reads and writes challenge documents without the generic machinery of PyYAML.
+#
+# Writing skips the representer, serializer and emitter, which analyze every scalar one character at a time. Exports only hold strings, ints, bools and None in a mapping, lists of those
+# and lists of flat mappings of those, so every string is written in one of three styles picked with a regex:
+# plain, a literal block for multi-line text, or double quoted with escapes. Anything else raises Unsupported and
+# the caller falls back to the generic dumper. The output loads as exactly the same data, but it is not laid out
+# byte for byte like the generic dumper's.
+#
+# Reading turns parser events straight into the challenge dicts instead of composing a tree of nodes and constructing
+# the data from it, and checks the shape of every challenge while it is being built. Plain scalars which can only be
+# strings skip the resolver. Explicit tags on mappings and sequences (!!set, !!omap, !!pairs) are not supported.
+# With the vendored PyYAML the parser builds no marks, unless a syntax error has to be reported.
+
+
+class Unsupported(Exception):
+    pass
+
+
+class SchemaError(ValueError):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return "Error: {}".format(self.message)
+
+
+class MissingFieldError(SchemaError):
+    def __init__(self, name):
+        super(MissingFieldError, self).__init__("Missing field '{}'".format(name))
+        self.name = name
+
+
+# Starts with a letter and holds printable ASCII other than ':' and '#', so it can not be mistaken for a number, a
+# date, a YAML indicator, a key or a comment
+PLAIN = re.compile(r'[A-Za-z_](?:[ !"$-9;-~]*[!"$-9;-~])?\Z')
+# Words the YAML 1.1 resolver turns into bools or null
+RESERVED = {'yes', 'no', 'true', 'false', 'on', 'off', 'null'}
+
+# Printable characters which are not line breaks or a byte order mark, plus tabs and newlines
+LITERAL = re.compile(r'[\t\n -~\xa0-\u2027\u202a-\ud7ff\ue000-\ufefe\uff00-\ufffd\U00010000-\U0010ffff]*\Z')
+TRAILING_SPACE = re.compile(r'[ \t]\n|[ \t]\Z')
+
+ESCAPED = re.compile(r'[\x00-\x1f\x7f-\xa0"\\\u2028\u2029\ud800-\udfff\ufeff\ufffe\uffff]')
+ESCAPES = {
+    '\0': '\\0', '\x07': '\\a', '\b': '\\b', '\t': '\\t', '\n': '\\n', '\x0b': '\\v', '\x0c': '\\f', '\r': '\\r',
+    '\x1b': '\\e', '"': '\\"', '\\': '\\\\', '\x85': '\\N', '\xa0': '\\_', '\u2028': '\\L', '\u2029': '\\P',
+}
+
+
+def _escape(match):
+    char = match.group()
+    if char in ESCAPES:
+        return ESCAPES[char]
+    if char <= '\xff':
+        return '\\x%02X' % ord(char)
+    return '\\u%04X' % ord(char)
+
+
+def scalar(value, indent):
+    # indent is the indentation of the lines of a literal block
+    if value is None:
+        return 'null'
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if type(value) is int:
+        return str(value)
+    if type(value) is not str:
+        raise Unsupported(type(value).__name__)
+
+    if PLAIN.match(value) and value.lower() not in RESERVED:
+        return value
+
+    if '\n' in value and value[0] not in ' \t\n' and not value.endswith('\n\n') and LITERAL.match(value) \
+            and not TRAILING_SPACE.search(value):
+        if value.endswith('\n'):
+            header, value = '|', value[:-1]
+        else:
+            header = '|-'
+        prefix = ' ' * indent
+        return header + ''.join('\n' + prefix + line if line else '\n' for line in value.split('\n'))
+
+    return '"' + ESCAPED.sub(_escape, value) + '"'
+
+
+def _key(key):
+    if type(key) is not str or not PLAIN.match(key) or key.lower() in RESERVED:
+        raise Unsupported(repr(key))
+    return key
+
+
+def _item(mapping):
+    # A flat mapping as an item of a top level sequence, its keys are indented to line up with the first one
+    lines = []
+    for key, value in mapping.items():
+        if isinstance(value, (list, dict)):
+            raise Unsupported('nested {}'.format(type(value).__name__))
+        lines.append(_key(key) + ': ' + scalar(value, 4))
+    return '- ' + '\n  '.join(lines) if lines else '- {}'
+
+
+def dump_challenge(properties):
+    if type(properties) is not dict:
+        raise Unsupported(type(properties).__name__)
+
+    lines = ['---']
+    for key, value in properties.items():
+        key = _key(key)
+        if isinstance(value, dict):
+            raise Unsupported('nested dict')
+        if not isinstance(value, list):
+            lines.append(key + ': ' + scalar(value, 2))
+        elif not value:
+            lines.append(key + ': []')
+        else:
+            lines.append(key + ':')
+            for item in value:
+                if isinstance(item, dict):
+                    lines.append(_item(item))
+                elif isinstance(item, list):
+                    raise Unsupported('nested list')
+                else:
+                    lines.append('- ' + scalar(item, 2))
+    return '\n'.join(lines) + '\n'
+
+
+def _flags_error(flags):
+    if not isinstance(flags, list):
+        return SchemaError("Field 'flags' must be a list")
+    return None
+
+
+def _flag_error(flag):
+    if not isinstance(flag, dict):
+        return SchemaError("Every flag must be a mapping")
+    if 'flag' in flag and not isinstance(flag['flag'], str):
+        return SchemaError("Field 'flag' of a flag must be a string")
+    return None
+
+
+def _challenge_error(chal, required):
+    if not isinstance(chal, dict):
+        return SchemaError("Document is not a mapping")
+    for field in required:
+        if field not in chal:
+            return MissingFieldError(field)
+    return None
+
+
+def check_challenge(chal, required=()):
+    # The first problem with the shape of a loaded challenge which stops it from being imported, or None
+    error = _challenge_error(chal, required)
+    if error is None and 'flags' in chal:
+        error = _flags_error(chal['flags'])
+        for flag in chal['flags'] if error is None else ():
+            error = _flag_error(flag)
+            if error is not None:
+                break
+    return error
+
+
+STR = 'tag:yaml.org,2002:str'
+MAP = 'tag:yaml.org,2002:map'
+SEQ = 'tag:yaml.org,2002:seq'
+MERGE = 'tag:yaml.org,2002:merge'
+VALUE = 'tag:yaml.org,2002:value'
+
+# Plain scalars the exporter writes for values, flags and hidden, and what the resolver makes of them
+CONSTANTS = {'true': True, 'false': False, 'null': None, '~': None, '': None}
+INT = re.compile(r'(?:0|[1-9][0-9]*)\Z')
+
+NO_KEY = object()
+MERGE_KEY = object()
+
+
+def _merge(mapping, merges, mark):
+    # Applies '<<' keys like SafeConstructor.flatten_mapping: keys of the mapping itself win over merged ones, later
+    # merges over earlier ones and earlier mappings in a merged list over later ones
+    merged = {}
+    for value in merges:
+        sources = [value] if isinstance(value, dict) else value[::-1] if isinstance(value, list) else None
+        if sources is None or not all(isinstance(source, dict) for source in sources):
+            raise yamlbackend.yaml.constructor.ConstructorError(
+                "while constructing a mapping", mark, "expected a mapping or list of mappings for merging", mark)
+        for source in sources:
+            merged.update(source)
+    merged.update(mapping)
+    mapping.clear()
+    mapping.update(merged)
+
+
+def _load_events(events, required):
+    yaml = yamlbackend.yaml
+    resolver = yaml.resolver.Resolver()
+    constructor = yaml.constructor.SafeConstructor()
+    ScalarEvent, AliasEvent = yaml.ScalarEvent, yaml.AliasEvent
+    MappingStartEvent, SequenceStartEvent = yaml.MappingStartEvent, yaml.SequenceStartEvent
+    MappingEndEvent, SequenceEndEvent = yaml.MappingEndEvent, yaml.SequenceEndEvent
+    DocumentStartEvent, DocumentEndEvent = yaml.DocumentStartEvent, yaml.DocumentEndEvent
+
+    def construct_scalar(event, key):
+        value = event.value
+        tag = event.tag
+        if tag is None or tag == '!':
+            if not event.implicit[0] or (PLAIN.match(value) and value.lower() not in RESERVED):
+                return value
+            if value in CONSTANTS:
+                return CONSTANTS[value]
+            if INT.match(value):
+                return int(value)
+            tag = resolver.resolve(yaml.ScalarNode, value, event.implicit)
+        if tag == STR:
+            return value
+        if key and tag == MERGE:
+            return MERGE_KEY
+        if key and tag == VALUE:
+            return value
+        try:
+            return constructor.construct_object(yaml.ScalarNode(tag, value, event.start_mark, event.end_mark, event.style))
+        finally:
+            constructor.constructed_objects.clear()
+
+    # Every open mapping or sequence is a frame of [container, pending key (NO_KEY for sequences and mappings which
+    # expect a key), merged values, role], where the role marks the challenge, its list of flags and each flag
+    stack = []
+    anchors = {}
+    root = error = None
+
+    for event in events:
+        cls = type(event)
+
+        if cls is ScalarEvent or cls is AliasEvent:
+            frame = stack[-1] if stack else None
+            if cls is ScalarEvent:
+                value = construct_scalar(event, frame is not None and frame[1] is NO_KEY and type(frame[0]) is dict)
+                if event.anchor is not None:
+                    anchors[event.anchor] = value
+            else:
+                if event.anchor not in anchors:
+                    raise yaml.composer.ComposerError(None, None, "found undefined alias {!r}".format(event.anchor), event.start_mark)
+                value = anchors[event.anchor]
+            collection = None
+
+        elif cls is MappingStartEvent or cls is SequenceStartEvent:
+            frame = stack[-1] if stack else None
+            if cls is MappingStartEvent:
+                if event.tag not in (None, '!', MAP):
+                    raise yaml.constructor.ConstructorError(None, None, "the fast challenge loader does not support the tag {!r}".format(event.tag), event.start_mark)
+                value = {}
+            else:
+                if event.tag not in (None, '!', SEQ):
+                    raise yaml.constructor.ConstructorError(None, None, "the fast challenge loader does not support the tag {!r}".format(event.tag), event.start_mark)
+                value = []
+            if event.anchor is not None:
+                anchors[event.anchor] = value
+            role = None
+            if frame is None:
+                role = 'challenge'
+            elif frame[3] == 'challenge' and frame[1] == 'flags':
+                role = 'flags'
+            elif frame[3] == 'flags':
+                role = 'flag'
+            collection = [value, NO_KEY, None, role]
+
+        elif cls is MappingEndEvent or cls is SequenceEndEvent:
+            container, _, merges, role = stack.pop()
+            if merges:
+                _merge(container, merges, event.start_mark)
+            if role == 'flag' and error is None:
+                error = _flag_error(container)
+            elif role == 'challenge':
+                # Missing fields are reported before problems with the flags, like the importer always did
+                error = _challenge_error(container, required) or error
+            continue
+
+        elif cls is DocumentStartEvent:
+            anchors = {}
+            root = error = None
+            continue
+
+        elif cls is DocumentEndEvent:
+            if error is None and not isinstance(root, dict):
+                error = _challenge_error(root, required)
+            yield root, error
+            continue
+
+        else:
+            continue
+
+        # Attach the scalar, alias or new collection to its parent
+        if frame is None:
+            root = value
+        elif type(frame[0]) is list:
+            frame[0].append(value)
+            if error is None and frame[3] == 'flags' and collection is None:
+                error = _flag_error(value)
+        elif frame[1] is NO_KEY:
+            if collection is not None:
+                # Mappings and sequences are constructed as dicts and lists, which can not be keys
+                raise yaml.constructor.ConstructorError("while constructing a mapping", None, "found unhashable key", event.start_mark)
+            frame[1] = value
+        else:
+            key = frame[1]
+            frame[1] = NO_KEY
+            if key is MERGE_KEY:
+                frame[2] = (frame[2] or []) + [value]
+            else:
+                try:
+                    frame[0][key] = value
+                except TypeError:
+                    raise yaml.constructor.ConstructorError("while constructing a mapping", None, "found unhashable key", event.start_mark)
+                if error is None and frame[3] == 'challenge' and key == 'flags':
+                    error = _flags_error(value)
+
+        if collection is not None:
+            stack.append(collection)
+
+
+UNMARKED = {}
+
+
+def _unmarked(loader):
+    # The vendored PyYAML can skip building the start and end marks of every token, event and node (see
+    # Reader.build_marks), libyaml and an installed PyYAML always build them
+    if getattr(loader, 'build_marks', None) is not True:
+        return None
+    if loader not in UNMARKED:
+        UNMARKED[loader] = type(loader.__name__, (loader,), {'build_marks': False})
+    return UNMARKED[loader]
+
+
+def _tell(stream):
+    # Where the stream can be read again from, None if it can't be
+    if isinstance(stream, (str, bytes)):
+        return 0
+    try:
+        return stream.tell() if stream.seekable() else None
+    except (AttributeError, OSError):
+        return None
+
+
+def load_challenges(stream, required=(), loader=None):
+    # Yields every document in the stream as (challenge, error), where error is the first SchemaError found in it or
+    # None. Syntax errors are raised like they are by yaml.load_all.
+    if not ENABLED and loader is None:
+        for chal in yamlbackend.load_all(stream):
+            yield chal, check_challenge(chal, required)
+        return
+
+    yaml = yamlbackend.yaml
+    loader = loader or yamlbackend.Loader
+    unmarked = _unmarked(loader)
+    start = _tell(stream) if unmarked is not None else None
+    if start is None:
+        yield from _load_events(yaml.parse(stream, Loader=loader), required)
+        return
+
+    try:
+        yield from _load_events(yaml.parse(stream, Loader=unmarked), required)
+    except yaml.MarkedYAMLError:
+        # Errors found without marks don't say where they are, so parse again with marks up to the same error
+        if not isinstance(stream, (str, bytes)):
+            stream.seek(start)
+        for document in _load_events(yaml.parse(stream, Loader=loader), required):
+            pass
+        raise
+
+
+
+# A document starts at every '---' at the start of a line which is followed by a space, a tab or the end of the line.
+# PyYAML ends any block scalar, plain scalar or block collection there, and rejects the stream if a quoted scalar or a
+# flow collection is still open, so the split does not have to track either: text it splits wrongly doesn't load.
+DOCUMENT_START = re.compile(r'^---(?=[ \t\r\n]|\Z)', re.M)
+DIRECTIVE = re.compile(r'^%', re.M)
+# Smallest batch of documents worth sending to another process, in characters
+BATCH_SIZE = 1 << 16
+
+
+def split_documents(text):
+    # Returns the text of every document in the stream, or None if directives (which apply to the documents after
+    # them) keep it from being split
+    if DIRECTIVE.search(text):
+        return None
+    starts = [match.start() for match in DOCUMENT_START.finditer(text)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    return [text[start:end] for start, end in zip(starts, starts[1:] + [len(text)])]
+
+
+def _batches(documents, size):
+    batch = []
+    length = 0
+    for document in documents:
+        batch.append(document)
+        length += len(document)
+        if length >= size:
+            yield ''.join(batch)
+            batch = []
+            length = 0
+    if batch:
+        yield ''.join(batch)
+
+
+def _load_batch(text, required):
+    # Runs in a worker process. Returns None if the batch doesn't load, the error is raised again by the parent.
+    try:
+        return list(load_challenges(text, required))
+    except Exception:
+        return None
+
+
+def load_challenges_parallel(stream, required=(), workers=None):
+    # Like load_challenges, but parses batches of documents in worker processes, one per CPU unless workers is given.
+    # Small streams, streams with directives and a single worker are loaded in this process. If a batch does not load
+    # the rest of the stream is loaded in this process, so errors are raised exactly like load_challenges raises them.
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        yield from load_challenges(stream, required)
+        return
+
+    text = stream if isinstance(stream, (str, bytes)) else stream.read()
+    documents = split_documents(text) if isinstance(text, str) else None
+    batches = list(_batches(documents, max(BATCH_SIZE, len(text) // (workers * 4)))) if documents else []
+    if len(batches) < 2:
+        yield from load_challenges(text, required)
+        return
+
+    loaded = 0
+    executor = ProcessPoolExecutor(min(workers, len(batches)))
+    futures = [executor.submit(_load_batch, batch, required) for batch in batches]
+    try:
+        for future in futures:
+            try:
+                challenges = future.result()
+            except Exception as e:
+                # e.g. a worker could not be started or a challenge could not be sent back
+                logger.debug("Loading a batch of challenges in a worker process failed: %s", e)
+                challenges = None
+            if challenges is None:
+                for index, challenge in enumerate(load_challenges(text, required)):
+                    if index >= loaded:
+                        yield challenge
+                return
+            loaded += len(challenges)
+            yield from challenges
+    finally:
+        # Don't wait for the batches still being loaded if the caller stopped early
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def check(documents):
+    # Returns the documents, by index, which do not load back as exactly the same data with either loader
+    problems = []
+    for index, document in enumerate(documents):
+        try:
+            text = dump_challenge(document)
+        except Unsupported:
+            continue
+        expected = yamlbackend.yaml.load(yamlbackend.dump(document), Loader=yamlbackend.yaml.SafeLoader)
+        for loader in {yamlbackend.yaml.SafeLoader, yamlbackend.Loader}:
+            if yamlbackend.yaml.load(text, Loader=loader) != expected:
+                problems.append(index)
+                break
+    return problems
+
+
+def _enabled():
+    if os.environ.get('CTFD_PORTABLE_YAML', 'fast') != 'fast':
+        return False
+    problems = check(yamlbackend.SAMPLE)
+    if problems:
+        logger.warning("Not using the fast challenge writer, it disagrees with PyYAML on sample documents %s", problems)
+    return not problems
+
+
+ENABLED = _enabled()
+
+
+def describe():
+    return yamlbackend.describe() + (', fast challenge writer' if ENABLED else '')
@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 
-import importlib
 import os
 import sys
 from flask import Flask
@@ -12,13 +11,30 @@ from werkzeug.utils import secure_filename
 import shutil
 import hashlib
 import argparse
-from sqlalchemy.sql import column
+import json
+import time
+import logging
+from sqlalchemy.orm.attributes import set_committed_value
 
-# Try to load PyYAMP if it's installed, if not load the local version
 try:
-    import yaml
-except ModuleNotFoundError:
-    from .lib import yaml
+    from .timing import TransferTimer, phase, timed
+    from .querycounter import QueryCounter
+    from .profiling import TransferProfiler
+    from .metrics import CHALLENGES
+    from .memory import MemoryTracker
+    from . import fastyaml, challengetypes
+    from .fastyaml import MissingFieldError
+except ImportError:
+    from timing import TransferTimer, phase, timed
+    from querycounter import QueryCounter
+    from profiling import TransferProfiler
+    from metrics import CHALLENGES
+    from memory import MemoryTracker
+    import fastyaml
+    import challengetypes
+    from fastyaml import MissingFieldError
+
+logger = logging.getLogger(__name__)
 
 REQ_FIELDS = ['name', 'description', 'value', 'category', 'flags']
 
@@ -39,6 +55,27 @@ def parse_args():
                         default=True)
     parser.add_argument('--move', dest="move", action='store_true',
                         help="if set the import proccess will move files rather than copy them", default=False)
+    parser.add_argument('--sync', dest="sync", action='store_true',
+                        help="if set, challenges which already exist (by name and category) are updated to match the input instead of being skipped or duplicated",
+                        default=False)
+    parser.add_argument('--journal', dest="journal", type=str,
+                        help="file to record the progress of the import in (default: [IN_FILE].journal when resuming)",
+                        default=None)
+    parser.add_argument('--resume', dest="resume", action='store_true',
+                        help="if set, skip the documents the journal lists as finished by an earlier run", default=False)
+    parser.add_argument('--plan', dest="plan", action='store_true',
+                        help="if set, print what the import would do as JSON without changing anything", default=False)
+    parser.add_argument('--profile', dest="profile", action='store_true',
+                        help="if set, run the import under cProfile and write the stats to [IN_FILE].prof", default=False)
+    parser.add_argument('--memory', dest="memory", action='store_true',
+                        help="if set, report the peak memory use of the import and the lines which allocated the most (makes the import slower)", default=False)
+    parser.add_argument('-v', '--verbose', dest="verbose", action='store_true',
+                        help="if set, also log the time taken by every challenge", default=False)
+    parser.add_argument('--content-addressed', dest="content_addressed", action='store_true',
+                        help="if set, keep one copy of every distinct file and store attachments as hardlinks to it",
+                        default=False)
+    parser.add_argument('-j', '--jobs', dest="jobs", type=int,
+                        help="number of processes to parse the YAML file with, 0 for one per CPU (default: 1)", default=1)
     return parser.parse_args()
 
 
@@ -61,267 +98,837 @@ def process_args(args):
     return args
 
 
-def get_chal_id(name):
-    from CTFd.models import Challenges
-    chal = Challenges.query.filter_by(name=name).first()
-    if not chal:
-        return None
-
-    return chal.id
+def update_reqs(imported, requirements):
+    from CTFd.models import db, Challenges
 
+    # Resolve names with a single query, the first challenge with a given name wins
+    chal_ids = {}
+    for chal_id, name in db.session.query(Challenges.id, Challenges.name).order_by(Challenges.id.desc()):
+        chal_ids[name] = chal_id
 
-def update_reqs(imported, requirements):
+    # Changed requirements are written with one executemany rather than an UPDATE per challenge
+    changes = []
     for chal in imported:
         if not chal.name in requirements:
             continue
 
         chal_reqs = []
         for req in requirements[chal.name]:
-            chal_id = get_chal_id(req)
+            chal_id = chal_ids.get(req)
             if chal_id:
                 chal_reqs.append(chal_id)
 
+        reqs = None
         if chal_reqs:
-            chal.requirements = {'prerequisites': chal_reqs}
+            reqs = {'prerequisites': chal_reqs}
+        if chal.requirements != reqs:
+            changes.append({'id': chal.id, 'requirements': reqs})
+            set_committed_value(chal, 'requirements', reqs)
 
+    if changes:
+        db.session.bulk_update_mappings(Challenges, changes)
 
-class MissingFieldError(Exception):
-    def __init__(self, name):
-        self.name = value
 
-    def __str__(self):
-        return "Error: Missing field '{}'".format(name)
+def file_digest(path, chunk_size=1024 * 1024):
+    hasher = hashlib.md5()
+    with phase('hash'), open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
 
 
-def import_challenges(in_file, dst_attachments, exit_on_error=True, move=False):
-    from CTFd.models import db, Challenges, Flags, Tags, Hints, ChallengeFiles
-    chals = []
-    imported = []
-    requirements = {}
-    with open(in_file, 'r') as in_stream:
-        chals = yaml.safe_load_all(in_stream)
-
-        for chal in chals:
-            skip = False
-            for req_field in REQ_FIELDS:
-                if req_field not in chal:
-                    if exit_on_error:
-                        raise MissingFieldError(req_field)
-                    else:
-                        print("Skipping challenge: Missing field '{}'".format(req_field))
-                        skip = True
+# With --content-addressed one copy of every payload is kept in this directory of the upload folder, named after its
+# MD5 hash, and the stored attachments are hardlinks to it
+CONTENT_DIR = '.content'
+
+
+def content_path(dst_attachments, digest):
+    return os.path.join(dst_attachments, CONTENT_DIR, digest)
+
+
+def store_file(srcpath, dst_attachments, attachments, move=False, content_addressed=False):
+    dst_filename = secure_filename(os.path.basename(srcpath))
+
+    # Every file gets a directory of its own, even if its content is shared, because CTFd deletes a file by removing
+    # its whole directory
+    dst_dir = None
+    while not dst_dir or os.path.exists(dst_dir):
+        md5hash = hashlib.md5(os.urandom(64)).hexdigest()
+        dst_dir = os.path.join(dst_attachments, md5hash)
+
+    os.makedirs(dst_dir)
+    dstpath = os.path.join(dst_dir, dst_filename)
+
+    if content_addressed:
+        stored = content_path(dst_attachments, file_digest(srcpath))
+        if os.path.exists(stored):
+            if move:
+                attachments.remove_source(srcpath, stored)
+        else:
+            os.makedirs(os.path.dirname(stored), exist_ok=True)
+            attachments.store(srcpath, stored, move)
+            with phase('copy'):
+                if move:
+                    shutil.move(srcpath, stored)
+                else:
+                    shutil.copy(srcpath, stored)
+
+        try:
+            attachments.store(stored, dstpath, False)
+            with phase('copy'):
+                os.link(stored, dstpath)
+            return dstpath
+        except OSError:
+            # The file system can't link, give the file a copy of its own
+            srcpath = stored
+            move = False
+
+    attachments.store(srcpath, dstpath, move)
+    with phase('copy'):
+        if move:
+            shutil.move(srcpath, dstpath)
+        else:
+            shutil.copy(srcpath, dstpath)
+
+    return dstpath
+
+
+class ImportJournal(object):
+    # An append-only log of JSON lines with the state of every document of an import. Each record is flushed to disk
+    # before the import moves on, so after a crash the journal says exactly which documents were finished ('done' or
+    # 'skipped') and which challenge was left half imported ('started', along with the files stored for it so far).
+    # Once a resumed import has cleaned up after a half imported challenge its document is 'removed' again.
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.finished = {}
+        self.started = {}
+
+        if resume and os.path.exists(path):
+            with open(path, 'r') as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn write from the crash, everything after it is unreliable
                         break
-            if skip:
+                    self._apply(record)
+
+        self.stream = open(path, 'a' if resume else 'w')
+
+    @staticmethod
+    def digest(chal):
+        return hashlib.sha256(json.dumps(chal, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def record(self, digest, status, **kwargs):
+        record = dict(kwargs, digest=digest, status=status)
+        self.stream.write(json.dumps(record) + '\n')
+        self.stream.flush()
+        os.fsync(self.stream.fileno())
+        self._apply(record)
+
+    def _apply(self, record):
+        digest = record['digest']
+        if record['status'] == 'started':
+            self.started[digest] = record
+        else:
+            self.started.pop(digest, None)
+            if record['status'] != 'removed':
+                self.finished[digest] = record
+
+    def close(self):
+        self.stream.close()
+
+
+def remove_challenge(chal_id):
+    from CTFd.models import db, Challenges, Flags, Tags, Hints, ChallengeFiles
+
+    for model in (Flags, Tags, Hints, ChallengeFiles):
+        model.query.filter_by(challenge_id=chal_id).delete(synchronize_session=False)
+
+    chal = Challenges.query.filter_by(id=chal_id).first()
+    if chal:
+        db.session.delete(chal)
+    db.session.commit()
+
+
+# Fills in the defaults of the flags and hints of a challenge. Files which can not be found are dropped from the
+# challenge and collected in missing_files if it is given, otherwise they are reported as they are found. The required
+# fields and the shape of the flags are already checked by fastyaml.load_challenges.
+def normalize_challenge(chal, in_file, exit_on_error=True, missing_files=None):
+    flags = []
+    for flag in chal['flags']:
+        if 'flag' not in flag:
+            if exit_on_error:
+                raise MissingFieldError('flag')
+            else:
+                logger.warning("Skipping flag: Missing field 'flag'")
+                continue
+        flag['flag'] = flag['flag'].strip()
+        if 'type' not in flag:
+            flag['type'] = "static"
+        if 'data' not in flag:
+            flag['data'] = ""
+        flags.append(flag)
+    chal['flags'] = flags
+
+    if 'files' in chal:
+        norm_files = []
+        for file in chal['files']:
+            # make sure we have only relative paths in the yaml file
+            file = os.path.normpath("/" + file).lstrip('/')
+            # skip files that do not exists
+            if not os.path.exists(os.path.join(os.path.dirname(in_file), file)):
+                if missing_files is not None:
+                    missing_files.append({'challenge': chal['name'].strip(), 'file': file})
+                else:
+                    logger.warning("Skipping file '%s' in challenge '%s': File not found", file, chal['name'].strip())
                 continue
+            else:
+                norm_files.append(file)
+        chal['files'] = norm_files
 
-            for flag in chal['flags']:
-                if 'flag' not in flag:
-                    if exit_on_error:
-                        raise MissingFieldError('flag')
-                    else:
-                        print("Skipping flag: Missing field 'flag'")
-                        continue
-                flag['flag'] = flag['flag'].strip()
-                if 'type' not in flag:
-                    flag['type'] = "static"
-                if 'data' not in flag:
-                    flag['data'] = ""
-
-            if 'files' in chal:
-                norm_files = []
-                for file in chal['files']:
-                    # make sure we have only relative paths in the yaml file
-                    file = os.path.normpath("/" + file).lstrip('/')
-                    # skip files that do not exists
-                    if not os.path.exists(os.path.join(os.path.dirname(in_file), file)):
-                        print("Skipping file '{}' in challenge '{}': File not found".format(file, chal['name'].strip()))
-                        continue
-                    else:
-                        norm_files.append(file)
-                chal['files'] = norm_files
+    if 'hints' not in chal:
+        chal['hints'] = []
+    for hint in chal['hints']:
+        if 'type' not in hint:
+            hint['type'] = "standard"
 
-            for hint in chal['hints']:
-                if 'type' not in hint:
-                    hint['type'] = "standard"
 
-            if 'requirements' in chal:
-                requirements[chal['name']] = chal['requirements']
+def challenge_fields(chal):
+    # We ignore traling and leading whitespace when importing challenges
+    fields = {
+        'name': chal['name'].strip(),
+        'description': chal['description'].strip(),
+        'value': int(chal['value']),
+        'category': chal['category'].strip(),
+        'state': 'visible',
+        'type': 'standard',
+    }
 
-            # Check what type the challenge is and create a DB object of the appropriate type.
-            if chal['type'] == 'dynamic':
-                # Lazy load the DynamicChallenge plugin on encountering a challenge of that type.
-                try:
-                    from CTFd.plugins.dynamic_challenges import DynamicChallenge
-                except ImportError as err:
-                    print("Failed to import plugin for challenge type {}: {}".format(chal['type'], err))
-                    continue
+    if 'hidden' in chal and chal['hidden']:
+        if bool(chal['hidden']):
+            fields['state'] = 'hidden'
+
+    if 'type' in chal and chal['type']:
+        fields['type'] = chal['type']
+
+    return fields
+
+
+def find_duplicate(chal, fields, in_file, candidates):
+    for match, tags_db, files_db in candidates.get(fields['name'], []):
+        if any(getattr(match, attr) != value for attr, value in fields.items()):
+            continue
+        if 'tags' in chal:
+            if all([tag not in tags_db for tag in chal['tags']]):
+                continue
+        if 'files' in chal:
+            if len(files_db) != len(chal['files']):
+                continue
+
+            hashes = []
+            for file_db in files_db:
+                hashes.append(file_digest(file_db))
+
+            mismatch = False
+            for file in chal['files']:
+                hash = file_digest(os.path.join(os.path.dirname(in_file), file))
+                if hash in hashes:
+                    hashes.remove(hash)
+                else:
+                    mismatch = True
+                    break
+            if mismatch:
+                continue
+
+        return match
+
+    return None
+
+
+# Decides what importing a normalized challenge does, given the challenges in the DB and those added earlier in the
+# same import: 'add' it, 'sync' the existing challenge returned along with it, or skip it, as a 'duplicate' or for any
+# other reason ('skip'), which is returned along with it.
+def classify_challenge(chal, fields, in_file, existing, candidates, sync=False):
+    try:
+        challengetypes.handler(fields['type']).model
+    except ImportError as err:
+        return 'skip', "Failed to import plugin for challenge type {}: {}".format(fields['type'], err)
+
+    if sync:
+        match = existing.get((fields['name'], fields['category']))
+        if match is None:
+            return 'add', None
+        if match.type != fields['type']:
+            return 'skip', "Challenge type changed from {} to {}".format(match.type, fields['type'])
+        return 'sync', match
+
+    if find_duplicate(chal, fields, in_file, candidates):
+        return 'duplicate', 'Duplicate challenge found in DB'
+    return 'add', None
+
+
+def new_challenge(chal, fields):
+    # Create a DB object of the appropriate type
+    chal_class = challengetypes.handler(fields['type']).model
+    chal_dbobj = chal_class(
+        name=fields['name'],
+        description=fields['description'],
+        value=fields['value'],
+        category=fields['category'],
+        **challengetypes.handler(fields['type']).import_fields(chal)
+    )
+    chal_dbobj.state = fields['state']
+    chal_dbobj.max_attempts = max_attempts(chal)
+    chal_dbobj.type = fields['type']
+    return chal_dbobj
+
+
+# The files of srcpaths which syncing a challenge that has the files at paths would store. Like sync_challenge they
+# are compared by name and content.
+def unmatched_files(srcpaths, paths):
+    remaining = list(paths)
+    unmatched = []
+    for srcpath in srcpaths:
+        name = secure_filename(os.path.basename(srcpath))
+        for path in remaining:
+            if secure_filename(os.path.basename(path)) != name or not os.path.exists(path):
+                continue
+            if os.path.getsize(path) == os.path.getsize(srcpath) and file_digest(path) == file_digest(srcpath):
+                remaining.remove(path)
+                break
+        else:
+            unmatched.append(srcpath)
+
+    return unmatched
 
-                initial = int(chal['value'])
-                if 'initial' in chal:
-                    initial = int(chal['initial'])
-
-                minimum = 0
-                if 'minimum' in chal:
-                    minimum = int(chal['minimum'])
-
-                decay = 0
-                if 'decay' in chal:
-                    decay = int(chal['decay'])
-
-                chal_dbobj = DynamicChallenge(
-                    name=chal['name'].strip(),
-                    description=chal['description'].strip(),
-                    value=int(chal['value']),
-                    category=chal['category'].strip(),
-                    initial=initial,
-                    decay=decay,
-                    minimum=minimum,
-                )
-            elif chal['type'] == 'naumachia':
-                # Lazy load the Naumachia plugin on encountering a challenge of that type.
-                try:
-                    # Here we use a fixed name, which is the repository name, even though it does
-                    # not conform to a proper Python package name. Users may install the package
-                    # using any file name they want, but this version of thsi plugin does not
-                    # support it.
-                    naumachia_plugin = importlib.import_module('.ctfd-naumachia-plugin', package="CTFd.plugins")
-                except ImportError as err:
-                    print("Failed to import plugin for challenge type {}: {}".format(chal['type'], err))
-                    continue
 
-                naumachia_name = chal.get('naumachia_name', "").strip(),
+# Works out what import_challenges would do with in_file without writing to the DB or the attachment directory
+def plan_import(in_file, dst_attachments, content_addressed=False, sync=False, jobs=1):
+    from CTFd.models import ChallengeFiles
 
-                chal_dbobj = naumachia_plugin.NaumachiaChallengeModel(
-                    name=chal['name'].strip(),
-                    naumachia_name=chal['naumachia_name'],
-                    description=chal['description'].strip(),
-                    value=int(chal['value']),
-                    category=chal['category'].strip(),
-                )
+    plan = {
+        'add': [],
+        'sync': [],
+        'skip': [],
+        'errors': [],
+        'missing_files': [],
+        'files': 0,
+        'bytes': 0,
+    }
+
+    with phase('query'):
+        existing_chals, rows = load_existing_challenges()
+    existing, candidates = index_challenges(existing_chals, rows, dst_attachments)
+    # The files the challenges added or synced by the plan end up with, by name and category, and the content which
+    # would be stored with content_addressed
+    planned_files = {}
+    pooled = set()
+
+    with open(in_file, 'r') as in_stream:
+        chals = timed('parse', fastyaml.load_challenges_parallel(in_stream, REQ_FIELDS, workers=jobs or None))
+
+        for index, (chal, error) in enumerate(chals):
+            if error is not None:
+                plan['errors'].append({'document': index, 'error': str(error)})
+                continue
+            try:
+                normalize_challenge(chal, in_file, exit_on_error=True, missing_files=plan['missing_files'])
+                fields = challenge_fields(chal)
+            except (MissingFieldError, AttributeError, TypeError, ValueError) as err:
+                plan['errors'].append({'document': index, 'error': str(err)})
+                continue
+
+            action, detail = classify_challenge(chal, fields, in_file, existing, candidates, sync=sync)
+            if action in ('skip', 'duplicate'):
+                plan['skip'].append({'name': fields['name'], 'reason': detail})
+                continue
+
+            key = (fields['name'], fields['category'])
+            srcpaths = [os.path.join(os.path.dirname(in_file), file) for file in chal.get('files', [])]
+            if action == 'sync':
+                paths = planned_files.get(key)
+                if paths is None:
+                    paths = [os.path.join(dst_attachments, f.location) for f in rows[ChallengeFiles].get(detail.id, [])]
+                plan['sync'].append(fields['name'])
+                stored = unmatched_files(srcpaths, paths)
             else:
-                # We ignore traling and leading whitespace when importing challenges
-                chal_dbobj = Challenges(
-                    name=chal['name'].strip(),
-                    description=chal['description'].strip(),
-                    value=int(chal['value']),
-                    category=chal['category'].strip(),
-                )
-
-            chal_dbobj.state = 'visible'
-            if 'hidden' in chal and chal['hidden']:
-                if bool(chal['hidden']):
-                    chal_dbobj.state = 'hidden'
-
-            chal_dbobj.max_attempts = 0
-            if 'max_attempts' in chal and chal['max_attempts']:
-                chal_dbobj.max_attempts = chal['max_attempts']
-
-            chal_dbobj.type = 'standard'
-            if 'type' in chal and chal['type']:
-                chal_dbobj.type = chal['type']
-
-            matching_chals = Challenges.query.filter_by(
-                name=chal_dbobj.name,
-                description=chal_dbobj.description,
-                value=chal_dbobj.value,
-                category=chal_dbobj.category,
-                state=chal_dbobj.state,
-                type=chal_dbobj.type
-            ).all()
-
-            for match in matching_chals:
-                if 'tags' in chal:
-                    tags_db = [tag.tag for tag in Tags.query.add_columns(column('tag')).filter_by(challenge_id=match.id).all()]
-                    if all([tag not in tags_db for tag in chal['tags']]):
-                        continue
-                if 'files' in chal:
-                    files_db = [f.location for f in ChallengeFiles.query.add_columns(column('location')).filter_by(challenge_id=match.id).all()]
-                    if len(files_db) != len(chal['files']):
+                try:
+                    chal_dbobj = new_challenge(chal, fields)
+                except (TypeError, ValueError) as err:
+                    plan['errors'].append({'document': index, 'error': str(err)})
+                    continue
+                # Later documents are checked against the challenge as if it was imported, it is never added to the
+                # session though
+                plan['add'].append(fields['name'])
+                candidates.setdefault(fields['name'], []).append((chal_dbobj, chal.get('tags', []), srcpaths))
+                if sync:
+                    existing[key] = chal_dbobj
+                stored = srcpaths
+            planned_files[key] = srcpaths
+
+            for srcpath in stored:
+                if content_addressed:
+                    digest = file_digest(srcpath)
+                    if digest in pooled or os.path.exists(content_path(dst_attachments, digest)):
                         continue
+                    pooled.add(digest)
+                plan['files'] += 1
+                plan['bytes'] += os.path.getsize(srcpath)
+
+    return plan
+
+
+def max_attempts(chal):
+    if 'max_attempts' in chal and chal['max_attempts']:
+        return chal['max_attempts']
+    return 0
+
+
+# Queues the rows belonging to a new challenge in pending, along with the challenge they belong to, which flush_rows
+# writes with one executemany per table once the challenge has an id. Returns the paths of the stored files.
+def add_challenge_rows(chal_dbobj, chal, in_file, dst_attachments, attachments, pending, move=False,
+                       content_addressed=False):
+    from CTFd.models import Flags, Tags, Hints, ChallengeFiles
+
+    if 'tags' in chal:
+        for tag in chal['tags']:
+            pending[Tags].append((chal_dbobj, {'value': tag}))
+
+    for flag in chal['flags']:
+        pending[Flags].append((chal_dbobj, {'content': flag['flag'], 'type': flag['type'], 'data': flag['data']}))
+
+    for hint in chal['hints']:
+        pending[Hints].append((chal_dbobj, {'content': hint['hint'], 'type': hint['type'], 'cost': int(hint['cost'])}))
+
+    dstpaths = []
+    if 'files' in chal:
+        for file in chal['files']:
+            srcpath = os.path.join(os.path.dirname(in_file), file)
+            dstpath = store_file(srcpath, dst_attachments, attachments, move=move, content_addressed=content_addressed)
+            dstpaths.append(dstpath)
+            # Bulk inserts do not fill in the discriminator of the Files table themselves
+            pending[ChallengeFiles].append((chal_dbobj, {'location': os.path.relpath(dstpath, start=dst_attachments),
+                                                         'type': ChallengeFiles.__mapper__.polymorphic_identity}))
+
+    return dstpaths
+
+
+def flush_rows(pending):
+    from CTFd.models import db
+
+    # New challenges are flushed together, which inserts the rows of their type specific tables with one executemany
+    # per table, and gives them the ids their rows refer to
+    db.session.flush()
+    for model, rows in pending.items():
+        if rows:
+            db.session.bulk_insert_mappings(model, [dict(mapping, challenge_id=chal_dbobj.id) for chal_dbobj, mapping in rows])
+            del rows[:]
+
+
+def reload_challenge_rows(chal_id, rows):
+    from CTFd.models import Flags, Tags, Hints, ChallengeFiles
+
+    # The rows of a challenge which was added or synced earlier in the same import, as they are in the session now
+    for model in (Flags, Hints, Tags, ChallengeFiles):
+        rows[model][chal_id] = model.query.filter_by(challenge_id=chal_id).order_by(model.id).all()
 
-                    hashes = []
-                    for file_db in files_db:
-                        with open(os.path.join(dst_attachments, file_db), 'rb') as f:
-                            hash = hashlib.md5(f.read()).digest()
-                            hashes.append(hash)
-
-                    mismatch = False
-                    for file in chal['files']:
-                        filepath = os.path.join(os.path.dirname(in_file), file)
-                        with open(filepath, 'rb') as f:
-                            hash = hashlib.md5(f.read()).digest()
-                            if hash in hashes:
-                                hashes.remove(hash)
-                            else:
-                                mismatch = True
-                                break
-                    if mismatch:
-                        continue
 
-                flags_db = Flags.query.filter_by(challenge_id=match.id).all()
-                for flag in chal['flags']:
-                    for flag_db in flags_db:
-                        if flag['flag'] != flag_db.content:
-                            continue
-                        if flag['type'] != flag_db.type:
-                            continue
+def load_existing_challenges():
+    from CTFd.models import db, Challenges, Flags, Tags, Hints, ChallengeFiles
 
-                skip = True
+    # Challenges of a type without a mapper, because its plugin is not loaded, can not be loaded at all
+    types = []
+    for (chal_type,) in db.session.query(Challenges.type).distinct():
+        try:
+            challengetypes.handler(chal_type).model
+        except ImportError:
+            pass
+        if chal_type in Challenges.__mapper__.polymorphic_map:
+            types.append(chal_type)
+
+    # Load every challenge along with its type specific columns, and all of the rows hanging off them, in one query
+    # per table rather than a handful of queries for each challenge.
+    chals = Challenges.query.with_polymorphic('*').filter(Challenges.type.in_(types)).order_by(Challenges.id).all()
+
+    rows = {}
+    for model in (Flags, Hints, Tags, ChallengeFiles):
+        rows[model] = {}
+        for row in model.query.all():
+            rows[model].setdefault(row.challenge_id, []).append(row)
+
+    return chals, rows
+
+
+# Indexes the challenges by name and category for syncing, and by name along with their tags and the paths of their
+# files for find_duplicate.
+def index_challenges(chals, rows, dst_attachments):
+    from CTFd.models import Tags, ChallengeFiles
+
+    existing = {}
+    candidates = {}
+    for chal in chals:
+        existing.setdefault((chal.name, chal.category), chal)
+        tags = [tag.value for tag in rows[Tags].get(chal.id, [])]
+        paths = [os.path.join(dst_attachments, f.location) for f in rows[ChallengeFiles].get(chal.id, [])]
+        candidates.setdefault(chal.name, []).append((chal, tags, paths))
+
+    return existing, candidates
+
+
+# Matches the rows already in the DB against the wanted (key, item) pairs. Rows without a match are deleted and items
+# without a match are created, rows which match are left alone. Returns the number of changed rows.
+def sync_rows(rows, wanted, row_key, create, delete):
+    remaining = list(rows)
+    changes = 0
+    for key, item in wanted:
+        for row in remaining:
+            if row_key(row) == key:
+                remaining.remove(row)
                 break
-            if skip:
-                print("Skipping '{}': Duplicate challenge found in DB".format(chal['name'].encode('utf8')))
-                continue
+        else:
+            create(item)
+            changes += 1
+
+    for row in remaining:
+        delete(row)
+        changes += 1
+
+    return changes
+
+
+def remove_stored(path):
+    # Removes a stored file along with its directory if nothing else is left in it
+    if os.path.exists(path):
+        os.remove(path)
+    dirname = os.path.dirname(path)
+    if os.path.isdir(dirname) and not os.listdir(dirname):
+        os.rmdir(dirname)
+
+
+class AttachmentChanges(object):
+    # Changes to the upload folder which belong to the database transaction of an import. Replaced attachments, and the
+    # sources of moved files which did not have to be moved, are only deleted from disk by commit(), after the
+    # transaction is committed. Used as a context manager it undoes what was stored since the last commit() if the
+    # import fails: copies and links are deleted and moved files are moved back, so the input can be imported again.
+    # If log is set, it is called with the files stored and the sources to remove since the last commit every time one
+    # is added, e.g. to write them to a journal.
+    def __init__(self, dst_attachments):
+        self.dst_attachments = dst_attachments
+        self.stored = []
+        self.removed = []
+        self.sources = []
+        self.log = None
+
+    def store(self, srcpath, dstpath, move):
+        # Called before the file is copied, linked or moved, so a failed attempt is cleaned up too
+        self.stored.append((os.path.abspath(srcpath), os.path.abspath(dstpath), move))
+        if self.log:
+            self.log(self.stored, self.sources)
+
+    def remove(self, location):
+        self.removed.append(location)
+
+    def remove_source(self, srcpath, stored):
+        # stored is the copy the source is a duplicate of, which it can be restored from
+        self.sources.append((os.path.abspath(srcpath), os.path.abspath(stored)))
+        if self.log:
+            self.log(self.stored, self.sources)
+
+    def commit(self):
+        for location in self.removed:
+            remove_stored(os.path.join(self.dst_attachments, location))
+        for srcpath, _ in self.sources:
+            if os.path.exists(srcpath):
+                os.remove(srcpath)
+        self.stored = []
+        self.removed = []
+        self.sources = []
+        self.log = None
+
+    def restore(self, stored, sources):
+        # Undoes the files an earlier run stored and logged before it died
+        self.stored = [tuple(entry) for entry in stored]
+        self.sources = [tuple(entry) for entry in sources]
+        self.rollback()
+
+    def rollback(self):
+        # Sources which were already deleted as duplicates are copied back first, while what they duplicate is still
+        # in place
+        for srcpath, stored in self.sources:
+            if not os.path.exists(srcpath) and os.path.exists(stored):
+                shutil.copy(stored, srcpath)
+        for srcpath, dstpath, move in reversed(self.stored):
+            if move and os.path.exists(dstpath) and not os.path.exists(srcpath):
+                shutil.move(dstpath, srcpath)
+            remove_stored(dstpath)
+        self.stored = []
+        self.removed = []
+        self.sources = []
+        self.log = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.rollback()
+
+
+def remove_file(file_dbobj, attachments):
+    from CTFd.models import db, ChallengeFiles
+
+    db.session.delete(file_dbobj)
+
+    # Files stored with --content-addressed by earlier versions may share a location with other challenges
+    shared = ChallengeFiles.query.filter(ChallengeFiles.location == file_dbobj.location,
+                                         ChallengeFiles.id != file_dbobj.id).count()
+    if not shared:
+        attachments.remove(file_dbobj.location)
+
+
+def sync_challenge(chal_dbobj, chal, fields, rows, in_file, dst_attachments, attachments, move=False, content_addressed=False):
+    from CTFd.models import db, Flags, Tags, Hints, ChallengeFiles
+
+    changes = 0
+    wanted = {
+        'description': fields['description'],
+        'value': fields['value'],
+        'state': fields['state'],
+        'max_attempts': max_attempts(chal),
+    }
+    wanted.update(challengetypes.handler(fields['type']).import_fields(chal))
+    for attr, value in wanted.items():
+        # Only assign what differs so the UPDATE only touches the changed columns
+        if getattr(chal_dbobj, attr) != value:
+            setattr(chal_dbobj, attr, value)
+            changes += 1
+
+    chal_id = chal_dbobj.id
+
+    changes += sync_rows(
+        rows[Flags].get(chal_id, []),
+        [((flag['flag'], flag['type'], flag['data']), flag) for flag in chal['flags']],
+        lambda row: (row.content, row.type, row.data or ''),
+        lambda flag: db.session.add(Flags(challenge_id=chal_id, content=flag['flag'], type=flag['type'], data=flag['data'])),
+        db.session.delete,
+    )
+
+    changes += sync_rows(
+        rows[Hints].get(chal_id, []),
+        [((hint['hint'], hint['type'], int(hint['cost'])), hint) for hint in chal['hints']],
+        lambda row: (row.content, row.type, row.cost),
+        lambda hint: db.session.add(Hints(challenge_id=chal_id, content=hint['hint'], type=hint['type'], cost=int(hint['cost']))),
+        db.session.delete,
+    )
+
+    changes += sync_rows(
+        rows[Tags].get(chal_id, []),
+        [(tag, tag) for tag in chal.get('tags', [])],
+        lambda row: row.value,
+        lambda tag: db.session.add(Tags(challenge_id=chal_id, value=tag)),
+        db.session.delete,
+    )
+
+    # Files are compared by name and content. The content of a file already in the upload folder is only read if the
+    # name and size match, and not at all if it is a link to the stored copy of the wanted content.
+    wanted_files = []
+    for file in chal.get('files', []):
+        srcpath = os.path.join(os.path.dirname(in_file), file)
+        wanted_files.append(((secure_filename(os.path.basename(file)), file_digest(srcpath), os.path.getsize(srcpath)), srcpath))
+
+    def same_file(row, key):
+        name, digest, size = key
+        dirname, filename = os.path.split(row.location)
+        if filename != name:
+            return False
+        if os.path.basename(dirname) == digest:
+            # Stored by an earlier version, which named the directory after the content
+            return True
+        path = os.path.join(dst_attachments, row.location)
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            return False
+        stored = content_path(dst_attachments, digest)
+        if os.path.exists(stored) and os.path.samefile(path, stored):
+            return True
+        return file_digest(path) == digest
+
+    def add_file(srcpath):
+        dstpath = store_file(srcpath, dst_attachments, attachments, move=move, content_addressed=content_addressed)
+        db.session.add(ChallengeFiles(challenge_id=chal_id, location=os.path.relpath(dstpath, start=dst_attachments)))
+
+    remaining = list(rows[ChallengeFiles].get(chal_id, []))
+    for key, srcpath in wanted_files:
+        for row in remaining:
+            if same_file(row, key):
+                remaining.remove(row)
+                break
+        else:
+            add_file(srcpath)
+            changes += 1
 
-            print("Adding {}".format(chal['name'].encode('utf8')))
-            imported.append(chal_dbobj)
-            db.session.add(chal_dbobj)
-            db.session.commit()
+    for row in remaining:
+        remove_file(row, attachments)
+        changes += 1
 
-            if 'tags' in chal:
-                for tag in chal['tags']:
-                    tag_dbobj = Tags(chal_dbobj.id, tag)
-                    db.session.add(tag_dbobj)
+    return changes
 
-            for flag in chal['flags']:
-                flag_db = Flags(challenge_id=chal_dbobj.id, content=flag['flag'], type=flag['type'], data=flag['data'])
-                db.session.add(flag_db)
 
-            for hint in chal['hints']:
-                hint_db = Hints(challenge_id=chal_dbobj.id, content=hint['hint'], type=hint['type'],
-                                cost=int(hint['cost']))
-                db.session.add(hint_db)
+def import_challenges(in_file, dst_attachments, exit_on_error=True, move=False, content_addressed=False, journal=None,
+                      sync=False, jobs=1):
+    from CTFd.models import db, Challenges, Flags, Tags, Hints, ChallengeFiles
+    chals = []
+    imported = []
+    requirements = {}
+    resumed = {}
+    pending = {Flags: [], Hints: [], Tags: [], ChallengeFiles: []}
+    attachments = AttachmentChanges(dst_attachments)
+    # Challenges added or synced by this import, by name and category
+    touched = set()
+    if journal:
+        for digest, record in list(journal.started.items()):
+            # The previous run died while adding or syncing this challenge. Its files are put back where they came from
+            # and a half imported challenge is removed before anything new can take its id.
+            attachments.restore(record.get('files', []), record.get('sources', []))
+            if not record.get('sync'):
+                logger.info("Removing partially imported challenge %s", record['id'])
+                with phase('commit'):
+                    remove_challenge(record['id'])
+            journal.record(digest, 'removed')
+
+    with phase('query'):
+        existing_chals, rows = load_existing_challenges()
+    existing, candidates = index_challenges(existing_chals, rows, dst_attachments)
+    # If the import fails, the files stored for whatever was not committed yet are removed or moved back
+    with open(in_file, 'r') as in_stream, attachments:
+        chals = timed('parse', fastyaml.load_challenges_parallel(in_stream, REQ_FIELDS, workers=jobs or None))
+
+        for chal, error in chals:
+            start = time.perf_counter()
+            if error is not None:
+                if exit_on_error:
+                    raise error
+                logger.warning("Skipping challenge: %s", error.message)
+                CHALLENGES.inc('import', 'skipped')
+                continue
 
-            if 'files' in chal:
-                for file in chal['files']:
-                    filename = os.path.basename(file)
-                    dst_filename = secure_filename(filename)
+            digest = None
+            if journal:
+                digest = journal.digest(chal)
+                if digest in journal.finished:
+                    record = journal.finished[digest]
+                    if record.get('requirements'):
+                        resumed[record['id']] = record['requirements']
+                    continue
 
-                    dst_dir = None
-                    while not dst_dir or os.path.exists(dst_dir):
-                        md5hash = hashlib.md5(os.urandom(64)).hexdigest()
-                        dst_dir = os.path.join(dst_attachments, md5hash)
+            normalize_challenge(chal, in_file, exit_on_error)
 
-                    os.makedirs(dst_dir)
-                    dstpath = os.path.join(dst_dir, dst_filename)
-                    srcpath = os.path.join(os.path.dirname(in_file), file)
+            if 'requirements' in chal:
+                requirements[chal['name']] = chal['requirements']
 
-                    if move:
-                        shutil.move(srcpath, dstpath)
-                    else:
-                        shutil.copy(srcpath, dstpath)
-                    file_dbobj = ChallengeFiles(challenge_id=chal_dbobj.id,
-                                                location=os.path.relpath(dstpath, start=dst_attachments))
+            fields = challenge_fields(chal)
+            action, detail = classify_challenge(chal, fields, in_file, existing, candidates, sync=sync)
+            if action == 'skip':
+                logger.warning("Skipping '%s': %s", fields['name'], detail)
+                CHALLENGES.inc('import', 'skipped')
+                if journal:
+                    journal.record(digest, 'skipped')
+                continue
 
-                    db.session.add(file_dbobj)
+            if action == 'duplicate':
+                logger.info("Skipping '%s': %s", fields['name'], detail)
+                CHALLENGES.inc('import', 'duplicate')
+                if journal:
+                    journal.record(digest, 'skipped')
+                continue
 
-        update_reqs(imported, requirements)
-        db.session.commit()
+            if action == 'sync':
+                match = detail
+                key = (fields['name'], fields['category'])
+                if key in touched:
+                    # The challenge appeared earlier in the file, sync against what that left in the session
+                    with phase('commit'):
+                        flush_rows(pending)
+                    with phase('query'):
+                        reload_challenge_rows(match.id, rows)
+                touched.add(key)
+
+                if journal:
+                    attachments.log = lambda stored, sources: journal.record(digest, 'started', id=match.id, sync=True,
+                                                                             files=stored, sources=sources)
+                with phase('query'):
+                    changes = sync_challenge(match, chal, fields, rows, in_file, dst_attachments, attachments,
+                                             move=move, content_addressed=content_addressed)
+                if changes:
+                    logger.info("Updating %s: %d changes", fields['name'], changes)
+
+                # Requirements are synced along with everything else, including removing them
+                imported.append(match)
+                requirements[fields['name']] = chal.get('requirements', [])
+
+                if journal:
+                    with phase('commit'):
+                        db.session.commit()
+                        attachments.commit()
+                    journal.record(digest, 'done', id=match.id, requirements=chal.get('requirements'))
+                CHALLENGES.inc('import', 'synced')
+                logger.debug("Synced %s in %.3fs", fields['name'], time.perf_counter() - start)
+                continue
+
+            chal_dbobj = new_challenge(chal, fields)
+            imported.append(chal_dbobj)
+            db.session.add(chal_dbobj)
+            if journal:
+                # A journaled challenge is committed on its own, the rest of the import is flushed in one go. It is
+                # journaled as started, with every file as it is stored, before any of it can be committed.
+                with phase('commit'):
+                    db.session.flush()
+                journal.record(digest, 'started', id=chal_dbobj.id)
+                attachments.log = lambda stored, sources: journal.record(digest, 'started', id=chal_dbobj.id,
+                                                                         files=stored, sources=sources)
+
+            dstpaths = add_challenge_rows(chal_dbobj, chal, in_file, dst_attachments, attachments, pending, move=move,
+                                          content_addressed=content_addressed)
+            candidates.setdefault(fields['name'], []).append((chal_dbobj, chal.get('tags', []), dstpaths))
+
+            if sync:
+                existing[(fields['name'], fields['category'])] = chal_dbobj
+                touched.add((fields['name'], fields['category']))
+
+            if journal:
+                # The challenge only counts as done once everything belonging to it is committed
+                with phase('commit'):
+                    flush_rows(pending)
+                    db.session.commit()
+                    attachments.commit()
+                journal.record(digest, 'done', id=chal_dbobj.id, requirements=chal.get('requirements'))
+
+            CHALLENGES.inc('import', 'imported')
+            logger.debug("Added %s in %.3fs", fields['name'], time.perf_counter() - start)
+
+        with phase('commit'):
+            flush_rows(pending)
+
+        with phase('query'):
+            if resumed:
+                # Challenges finished by an earlier run still need their requirements linked
+                for chal_dbobj in Challenges.query.filter(Challenges.id.in_(list(resumed))).all():
+                    imported.append(chal_dbobj)
+                    requirements[chal_dbobj.name] = resumed[chal_dbobj.id]
+
+            update_reqs(imported, requirements)
+
+        with phase('commit'):
+            db.session.commit()
+            attachments.commit()
 
     db.session.close()
 
 
 if __name__ == "__main__":
     args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(message)s')
+    logger.info("YAML backend: %s", fastyaml.describe())
 
     app = Flask(__name__)
 
@@ -335,15 +942,47 @@ if __name__ == "__main__":
             url.drivername = 'postgresql'
 
         db.init_app(app)
+        app.db = db
 
-        try:
-            if not (url.drivername.startswith('sqlite') or database_exists(url)):
-                create_database(url)
-            db.create_all()
-        except OperationalError:
-            db.create_all()
+        profiler = TransferProfiler(args.in_file + '.prof', enabled=args.profile)
+        tracker = MemoryTracker(enabled=args.memory)
+        if args.plan:
+            # Planning only reads, so leave the database exactly as it is
+            with TransferTimer('Import plan') as timer, QueryCounter(db.engine) as counter, profiler, tracker:
+                plan = plan_import(args.in_file, args.dst_attachments, content_addressed=args.content_addressed,
+                                   sync=args.sync, jobs=args.jobs)
+            logger.info(timer.summary())
+            logger.info(counter.summary())
+            if profiler.active:
+                logger.info("Profile written to %s\n%s", profiler.stats_file, profiler.summary())
+            if tracker.enabled:
+                logger.info(tracker.summary())
+            print(json.dumps(plan, indent=2))
         else:
-            db.create_all()
-
-        app.db = db
-        import_challenges(args.in_file, args.dst_attachments, args.exit_on_error, move=args.move)
+            try:
+                if not (url.drivername.startswith('sqlite') or database_exists(url)):
+                    create_database(url)
+                db.create_all()
+            except OperationalError:
+                db.create_all()
+            else:
+                db.create_all()
+
+            journal = None
+            if args.journal or args.resume:
+                journal = ImportJournal(args.journal or args.in_file + '.journal', resume=args.resume)
+
+            try:
+                with TransferTimer('Import') as timer, QueryCounter(db.engine) as counter, profiler, tracker:
+                    import_challenges(args.in_file, args.dst_attachments, args.exit_on_error, move=args.move,
+                                      content_addressed=args.content_addressed, journal=journal, sync=args.sync,
+                                      jobs=args.jobs)
+                logger.info(timer.summary())
+                logger.info(counter.summary())
+                if profiler.active:
+                    logger.info("Profile written to %s\n%s", profiler.stats_file, profiler.summary())
+                if tracker.enabled:
+                    logger.info(tracker.summary())
+            finally:
+                if journal:
+                    journal.close()
@@ -0,0 +1,66 @@
+import os
+import time
+import uuid
+import shutil
+import threading
+from tempfile import mkdtemp
+from collections import OrderedDict
+
+
+class JobRegistry(object):
+    # Keeps a record of the most recent transfers in memory, so their timings and profiles can be looked up after the
+    # request which ran them has finished. Every job may keep files (e.g. profiler stats) in a directory of its own,
+    # which is removed along with the record once the job falls out of the registry.
+    def __init__(self, limit=50):
+        self.limit = limit
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._directory = None
+
+    def start(self, kind, **fields):
+        job = dict(fields, id=uuid.uuid4().hex, kind=kind, status='running', started=time.time())
+        with self._lock:
+            self._jobs[job['id']] = job
+            while len(self._jobs) > self.limit:
+                job_id, evicted = self._jobs.popitem(last=False)
+                if evicted.get('directory'):
+                    shutil.rmtree(evicted['directory'], ignore_errors=True)
+        return job
+
+    def finish(self, job, status='done', **fields):
+        with self._lock:
+            job.update(fields)
+            job['status'] = status
+            job['finished'] = time.time()
+
+    def directory(self, job):
+        # Creates the directory for the files of a job on first use
+        with self._lock:
+            if self._directory is None:
+                self._directory = mkdtemp(prefix='ctfd-portable-jobs-')
+            if not job.get('directory'):
+                job['directory'] = os.path.join(self._directory, job['id'])
+                os.makedirs(job['directory'])
+            return job['directory']
+
+    def file(self, job_id, name):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job or not job.get('directory'):
+                return None
+            path = os.path.join(job['directory'], name)
+            return path if os.path.exists(path) else None
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self.status(job) if job else None
+
+    def list(self):
+        with self._lock:
+            return [self.status(job) for job in reversed(self._jobs.values())]
+
+    @staticmethod
+    def status(job):
+        # Paths on the server are not part of the status
+        return {key: value for key, value in job.items() if key != 'directory'}
@@ -11,6 +11,8 @@ __all__ = ['Emitter', 'EmitterError']
 from .error import YAMLError
 from .events import *
 
+import functools, re
+
 class EmitterError(YAMLError):
     pass
 
@@ -41,6 +43,10 @@ class Emitter:
         # The stream should have the methods `write` and possibly `flush`.
         self.stream = stream
 
+        # Fragments waiting to be written to the stream and their length.
+        self.pending = []
+        self.pending_length = 0
+
         # Encoding can be overridden by STREAM-START.
         self.encoding = None
 
@@ -623,7 +629,28 @@ class Emitter:
                         % (ch, anchor))
         return anchor
 
+    # Keys and values like 'flag', 'type' and 'static' are emitted over and
+    # over, so the analyses of short scalars are kept in a bounded cache. They
+    # only depend on the scalar and allow_unicode, and are never modified.
+    ANALYSIS_CACHE_LENGTH = 128
+
     def analyze_scalar(self, scalar):
+        if len(scalar) <= self.ANALYSIS_CACHE_LENGTH:
+            return self.cached_analysis(scalar, bool(self.allow_unicode))
+        return self.compute_analysis(scalar, bool(self.allow_unicode))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def cached_analysis(scalar, allow_unicode):
+        return Emitter.compute_analysis(scalar, allow_unicode)
+
+    ASCII_SCALAR = re.compile(r'[\n -~]+\Z')
+    FLOW_INDICATOR = re.compile(r'[,?\[\]{}:]')
+    COLON_INDICATOR = re.compile(r':(?:[ \n]|\Z)')
+    COMMENT_INDICATOR = re.compile(r'[ \n]#')
+
+    @staticmethod
+    def compute_analysis(scalar, allow_unicode):
 
         # Empty scalar is a special case.
         if not scalar:
@@ -632,6 +659,11 @@ class Emitter:
                     allow_single_quoted=True, allow_double_quoted=True,
                     allow_block=False)
 
+        # Most scalars are printable ASCII, which can be analyzed with a few
+        # searches instead of looking at every character.
+        if Emitter.ASCII_SCALAR.match(scalar):
+            return Emitter.analyze_ascii_scalar(scalar)
+
         # Indicators and special characters.
         block_indicators = False
         flow_indicators = False
@@ -701,7 +733,7 @@ class Emitter:
                         or '\uE000' <= ch <= '\uFFFD'
                         or '\U00010000' <= ch < '\U0010ffff') and ch != '\uFEFF':
                     unicode_characters = True
-                    if not self.allow_unicode:
+                    if not allow_unicode:
                         special_characters = True
                 else:
                     special_characters = True
@@ -735,6 +767,45 @@ class Emitter:
             followed_by_whitespace = (index+1 >= len(scalar) or
                     scalar[index+1] in '\0 \t\r\n\x85\u2028\u2029')
 
+        return Emitter.allowed_styles(scalar, line_breaks, flow_indicators,
+                block_indicators, special_characters, leading_space,
+                leading_break, trailing_space, trailing_break, break_space,
+                space_break)
+
+    @staticmethod
+    def analyze_ascii_scalar(scalar):
+        # The same analysis as compute_analysis() for a non-empty scalar of
+        # printable ASCII characters and line feeds.
+        first = scalar[0]
+        last = scalar[-1]
+        followed_by_whitespace = len(scalar) == 1 or scalar[1] in ' \n'
+
+        flow_indicators = block_indicators =    \
+                scalar.startswith('---') or scalar.startswith('...')
+        if first in '#,[]{}&*!|>\'\"%@`':
+            flow_indicators = block_indicators = True
+        elif first in '?:':
+            flow_indicators = True
+            if followed_by_whitespace:
+                block_indicators = True
+        elif first == '-' and followed_by_whitespace:
+            flow_indicators = block_indicators = True
+        if Emitter.FLOW_INDICATOR.search(scalar, 1):
+            flow_indicators = True
+        if Emitter.COLON_INDICATOR.search(scalar, 1)  \
+                or Emitter.COMMENT_INDICATOR.search(scalar):
+            flow_indicators = block_indicators = True
+
+        return Emitter.allowed_styles(scalar, '\n' in scalar,
+                flow_indicators, block_indicators, False, first == ' ',
+                first == '\n', last == ' ', last == '\n', '\n ' in scalar,
+                ' \n' in scalar)
+
+    @staticmethod
+    def allowed_styles(scalar, line_breaks, flow_indicators, block_indicators,
+            special_characters, leading_space, leading_break, trailing_space,
+            trailing_break, break_space, space_break):
+
         # Let's decide what styles are allowed.
         allow_flow_plain = True
         allow_block_plain = True
@@ -785,7 +856,29 @@ class Emitter:
 
     # Writers.
 
+    # Indicators, indents and pieces of scalars are collected and written in
+    # chunks of about this many characters, each encoded in one go, instead
+    # of in one call to `write` each. They are flushed at the end of every
+    # document.
+    WRITE_BUFFER_SIZE = 65536
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_length += len(data)
+        if self.pending_length >= self.WRITE_BUFFER_SIZE:
+            self.flush_pending()
+
+    def flush_pending(self):
+        if self.pending:
+            data = ''.join(self.pending)
+            self.pending = []
+            self.pending_length = 0
+            if self.encoding:
+                data = data.encode(self.encoding)
+            self.stream.write(data)
+
     def flush_stream(self):
+        self.flush_pending()
         if hasattr(self.stream, 'flush'):
             self.stream.flush()
 
@@ -807,9 +900,7 @@ class Emitter:
         self.indention = self.indention and indention
         self.column += len(data)
         self.open_ended = False
-        if self.encoding:
-            data = data.encode(self.encoding)
-        self.stream.write(data)
+        self.write(data)
 
     def write_indent(self):
         indent = self.indent or 0
@@ -820,9 +911,7 @@ class Emitter:
             self.whitespace = True
             data = ' '*(indent-self.column)
             self.column = indent
-            if self.encoding:
-                data = data.encode(self.encoding)
-            self.stream.write(data)
+            self.write(data)
 
     def write_line_break(self, data=None):
         if data is None:
@@ -831,22 +920,16 @@ class Emitter:
         self.indention = True
         self.line += 1
         self.column = 0
-        if self.encoding:
-            data = data.encode(self.encoding)
-        self.stream.write(data)
+        self.write(data)
 
     def write_version_directive(self, version_text):
         data = '%%YAML %s' % version_text
-        if self.encoding:
-            data = data.encode(self.encoding)
-        self.stream.write(data)
+        self.write(data)
         self.write_line_break()
 
     def write_tag_directive(self, handle_text, prefix_text):
         data = '%%TAG %s %s' % (handle_text, prefix_text)
-        if self.encoding:
-            data = data.encode(self.encoding)
-        self.stream.write(data)
+        self.write(data)
         self.write_line_break()
 
     # Scalar streams.
@@ -868,9 +951,7 @@ class Emitter:
                     else:
                         data = text[start:end]
                         self.column += len(data)
-                        if self.encoding:
-                            data = data.encode(self.encoding)
-                        self.stream.write(data)
+                        self.write(data)
                     start = end
             elif breaks:
                 if ch is None or ch not in '\n\x85\u2028\u2029':
@@ -888,16 +969,12 @@ class Emitter:
                     if start < end:
                         data = text[start:end]
                         self.column += len(data)
-                        if self.encoding:
-                            data = data.encode(self.encoding)
-                        self.stream.write(data)
+                        self.write(data)
                         start = end
             if ch == '\'':
                 data = '\'\''
                 self.column += 2
-                if self.encoding:
-                    data = data.encode(self.encoding)
-                self.stream.write(data)
+                self.write(data)
                 start = end + 1
             if ch is not None:
                 spaces = (ch == ' ')
@@ -938,9 +1015,7 @@ class Emitter:
                 if start < end:
                     data = text[start:end]
                     self.column += len(data)
-                    if self.encoding:
-                        data = data.encode(self.encoding)
-                    self.stream.write(data)
+                    self.write(data)
                     start = end
                 if ch is not None:
                     if ch in self.ESCAPE_REPLACEMENTS:
@@ -952,9 +1027,7 @@ class Emitter:
                     else:
                         data = '\\U%08X' % ord(ch)
                     self.column += len(data)
-                    if self.encoding:
-                        data = data.encode(self.encoding)
-                    self.stream.write(data)
+                    self.write(data)
                     start = end+1
             if 0 < end < len(text)-1 and (ch == ' ' or start >= end)    \
                     and self.column+(end-start) > self.best_width and split:
@@ -962,18 +1035,14 @@ class Emitter:
                 if start < end:
                     start = end
                 self.column += len(data)
-                if self.encoding:
-                    data = data.encode(self.encoding)
-                self.stream.write(data)
+                self.write(data)
                 self.write_indent()
                 self.whitespace = False
                 self.indention = False
                 if text[start] == ' ':
                     data = '\\'
                     self.column += len(data)
-                    if self.encoding:
-                        data = data.encode(self.encoding)
-                    self.stream.write(data)
+                    self.write(data)
             end += 1
         self.write_indicator('"', False)
 
@@ -1023,17 +1092,13 @@ class Emitter:
                     else:
                         data = text[start:end]
                         self.column += len(data)
-                        if self.encoding:
-                            data = data.encode(self.encoding)
-                        self.stream.write(data)
+                        self.write(data)
                     start = end
             else:
                 if ch is None or ch in ' \n\x85\u2028\u2029':
                     data = text[start:end]
                     self.column += len(data)
-                    if self.encoding:
-                        data = data.encode(self.encoding)
-                    self.stream.write(data)
+                    self.write(data)
                     if ch is None:
                         self.write_line_break()
                     start = end
@@ -1067,9 +1132,7 @@ class Emitter:
             else:
                 if ch is None or ch in '\n\x85\u2028\u2029':
                     data = text[start:end]
-                    if self.encoding:
-                        data = data.encode(self.encoding)
-                    self.stream.write(data)
+                    self.write(data)
                     if ch is None:
                         self.write_line_break()
                     start = end
@@ -1085,9 +1148,7 @@ class Emitter:
         if not self.whitespace:
             data = ' '
             self.column += len(data)
-            if self.encoding:
-                data = data.encode(self.encoding)
-            self.stream.write(data)
+            self.write(data)
         self.whitespace = False
         self.indention = False
         spaces = False
@@ -1106,9 +1167,7 @@ class Emitter:
                     else:
                         data = text[start:end]
                         self.column += len(data)
-                        if self.encoding:
-                            data = data.encode(self.encoding)
-                        self.stream.write(data)
+                        self.write(data)
                     start = end
             elif breaks:
                 if ch not in '\n\x85\u2028\u2029':
@@ -1127,9 +1186,7 @@ class Emitter:
                 if ch is None or ch in ' \n\x85\u2028\u2029':
                     data = text[start:end]
                     self.column += len(data)
-                    if self.encoding:
-                        data = data.encode(self.encoding)
-                    self.stream.write(data)
+                    self.write(data)
                     start = end
             if ch is not None:
                 spaces = (ch == ' ')
@@ -19,7 +19,7 @@ __all__ = ['Reader', 'ReaderError']
 
 from .error import YAMLError, Mark
 
-import codecs, re
+import codecs, mmap, re
 
 class ReaderError(YAMLError):
 
@@ -82,6 +82,35 @@ class Reader(object):
             self.name = getattr(stream, 'name', "<file>")
             self.eof = False
             self.raw_buffer = None
+            if self.whole_file and self.seekable(stream):
+                self.read_whole()
+            else:
+                self.determine_encoding()
+
+    # Files, in memory streams and mmaps are read in one piece, so the text
+    # is decoded and checked once and the buffer is never sliced again. Only
+    # pipes, sockets and the like are read 4096 bytes at a time. Loaders set
+    # `whole_file = False` to keep the memory of huge files down.
+    whole_file = True
+
+    @staticmethod
+    def seekable(stream):
+        if isinstance(stream, mmap.mmap):
+            return True
+        try:
+            return stream.seekable()
+        except (AttributeError, ValueError):
+            return False
+
+    def read_whole(self):
+        data = self.stream.read()
+        self.stream_pointer = len(data)
+        self.eof = True
+        if isinstance(data, str):
+            self.check_printable(data)
+            self.buffer = data+'\0'
+        else:
+            self.raw_buffer = data
             self.determine_encoding()
 
     def peek(self, index=0):
@@ -96,9 +125,21 @@ class Reader(object):
             self.update(length)
         return self.buffer[self.pointer:self.pointer+length]
 
+    # Line breaks and the byte order mark, the only characters which do not
+    # simply move the column one to the right.
+    SPECIAL = re.compile('[\n\r\x85\u2028\u2029\uFEFF]')
+
     def forward(self, length=1):
         if self.pointer+length+1 >= len(self.buffer):
             self.update(length+1)
+        if length > 1 and not self.SPECIAL.search(self.buffer,
+                self.pointer, self.pointer+length):
+            # A run of ordinary characters, e.g. a line of a long
+            # description, is consumed in one step.
+            self.pointer += length
+            self.index += length
+            self.column += length
+            return
         while length:
             ch = self.buffer[self.pointer]
             self.pointer += 1
@@ -111,7 +152,30 @@ class Reader(object):
                 self.column += 1
             length -= 1
 
+    def match_length(self, pattern):
+        # Returns the length of the run of characters matching `pattern` at
+        # the current position. More of the stream is read while the run, or
+        # the character after it which `pattern` may need to look at, reaches
+        # the end of the buffer. `pattern` must be a repetition which can be
+        # resumed where it stopped.
+        length = 0
+        while True:
+            length = pattern.match(self.buffer, self.pointer+length).end()  \
+                    - self.pointer
+            if self.pointer+length+1 < len(self.buffer)  \
+                    or self.raw_buffer is None:
+                return length
+            self.update(length+2)
+
+    # Every token, event and node carries a start and an end mark, which are
+    # only read to point at errors. A loader with `build_marks = False` builds
+    # none of them, the errors it raises then say what is wrong but not where,
+    # so the caller should parse again with marks to report one.
+    build_marks = True
+
     def get_mark(self):
+        if not self.build_marks:
+            return None
         if self.stream is None:
             return Mark(self.name, self.index, self.line, self.column,
                     self.buffer, self.pointer)
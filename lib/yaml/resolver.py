@@ -16,6 +16,7 @@ class BaseResolver:
     DEFAULT_MAPPING_TAG = 'tag:yaml.org,2002:map'
 
     yaml_implicit_resolvers = {}
+    yaml_implicit_cache = (None, {})
     yaml_path_resolvers = {}
 
     def __init__(self):
@@ -33,6 +34,7 @@ class BaseResolver:
             first = [None]
         for ch in first:
             cls.yaml_implicit_resolvers.setdefault(ch, []).append((tag, regexp))
+        cls.yaml_implicit_cache = (cls.yaml_implicit_resolvers, {})
 
     @classmethod
     def add_path_resolver(cls, tag, path, kind=None):
@@ -140,16 +142,20 @@ class BaseResolver:
                 return
         return True
 
+    # Plain scalars like 'static', 'true' or '100' are resolved over and over,
+    # so the implicit tags of short scalars are kept in a bounded cache. The
+    # cache is tied to the yaml_implicit_resolvers it was filled from and is
+    # replaced whenever a resolver is added or the table is reassigned. Words
+    # whose first character has no resolvers at all (most names, categories
+    # and flags) skip the regexes and the cache entirely.
+    IMPLICIT_CACHE_LENGTH = 128
+    IMPLICIT_CACHE_SIZE = 4096
+
     def resolve(self, kind, value, implicit):
         if kind is ScalarNode and implicit[0]:
-            if value == '':
-                resolvers = self.yaml_implicit_resolvers.get('', [])
-            else:
-                resolvers = self.yaml_implicit_resolvers.get(value[0], [])
-            wildcard_resolvers = self.yaml_implicit_resolvers.get(None, [])
-            for tag, regexp in resolvers + wildcard_resolvers:
-                if regexp.match(value):
-                    return tag
+            tag = self.resolve_implicit(value)
+            if tag is not None:
+                return tag
             implicit = implicit[1]
         if self.yaml_path_resolvers:
             exact_paths = self.resolver_exact_paths[-1]
@@ -164,6 +170,29 @@ class BaseResolver:
         elif kind is MappingNode:
             return self.DEFAULT_MAPPING_TAG
 
+    def resolve_implicit(self, value):
+        resolvers = self.yaml_implicit_resolvers
+        first = value[:1]
+        if first not in resolvers and None not in resolvers:
+            return None
+        owner, cache = self.yaml_implicit_cache
+        if owner is not resolvers:
+            cache = {}
+            self.__class__.yaml_implicit_cache = (resolvers, cache)
+        tag = cache.get(value, cache)
+        if tag is not cache:
+            return tag
+        tag = None
+        for candidate, regexp in resolvers.get(first, []) + resolvers.get(None, []):
+            if regexp.match(value):
+                tag = candidate
+                break
+        if len(value) <= self.IMPLICIT_CACHE_LENGTH:
+            if len(cache) >= self.IMPLICIT_CACHE_SIZE:
+                cache.clear()
+            cache[value] = tag
+        return tag
+
 class Resolver(BaseResolver):
     pass
 
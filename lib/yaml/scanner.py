@@ -29,6 +29,8 @@ __all__ = ['Scanner', 'ScannerError']
 from .error import MarkedYAMLError
 from .tokens import *
 
+import re
+
 class ScannerError(MarkedYAMLError):
     pass
 
@@ -45,6 +47,25 @@ class SimpleKey:
 
 class Scanner:
 
+    # Runs of characters which are consumed in one step instead of peeking
+    # at them one by one, see Reader.match_length(). Spaces are part of a run
+    # as long as what follows them would be too, only spaces before a line
+    # break or the end of a scalar are special. A colon only ends a plain
+    # scalar if it is followed by a space (or a flow indicator in the flow
+    # context), and so does a '#' after a space.
+    PLAIN_BLOCK = re.compile('(?:[^\0 \t\r\n\x85\u2028\u2029:]'
+            '|:(?=[^\0 \t\r\n\x85\u2028\u2029])'
+            '| +(?=[^\0 \t\r\n\x85\u2028\u2029:#]'
+                '|:[^\0 \t\r\n\x85\u2028\u2029]))*')
+    PLAIN_FLOW = re.compile('(?:[^\0 \t\r\n\x85\u2028\u2029:,?\\[\\]{}]'
+            '|:(?=[^\0 \t\r\n\x85\u2028\u2029,\\[\\]{}])'
+            '| +(?=[^\0 \t\r\n\x85\u2028\u2029:#,?\\[\\]{}]'
+                '|:[^\0 \t\r\n\x85\u2028\u2029,\\[\\]{}]))*')
+    QUOTED = re.compile('(?:[^\'\"\\\\\0 \t\r\n\x85\u2028\u2029]'
+            '|[ \t]+(?=[^\0 \t\r\n\x85\u2028\u2029]))*')
+    LINE = re.compile('[^\0\r\n\x85\u2028\u2029]*')
+    SPACES = re.compile(' *')
+
     def __init__(self):
         """Initialize the scanner."""
         # It is assumed that Scanner and Reader will have a common descendant.
@@ -773,11 +794,9 @@ class Scanner:
             self.forward()
         found = False
         while not found:
-            while self.peek() == ' ':
-                self.forward()
+            self.forward(self.match_length(self.SPACES))
             if self.peek() == '#':
-                while self.peek() not in '\0\r\n\x85\u2028\u2029':
-                    self.forward()
+                self.forward(self.match_length(self.LINE))
             if self.scan_line_break():
                 if not self.flow_level:
                     self.allow_simple_key = True
@@ -798,8 +817,7 @@ class Scanner:
             end_mark = self.get_mark()
         else:
             end_mark = self.get_mark()
-            while self.peek() not in '\0\r\n\x85\u2028\u2029':
-                self.forward()
+            self.forward(self.match_length(self.LINE))
         self.scan_directive_ignored_line(start_mark)
         return DirectiveToken(name, value, start_mark, end_mark)
 
@@ -887,8 +905,7 @@ class Scanner:
         while self.peek() == ' ':
             self.forward()
         if self.peek() == '#':
-            while self.peek() not in '\0\r\n\x85\u2028\u2029':
-                self.forward()
+            self.forward(self.match_length(self.LINE))
         ch = self.peek()
         if ch not in '\0\r\n\x85\u2028\u2029':
             raise ScannerError("while scanning a directive", start_mark,
@@ -1005,9 +1022,7 @@ class Scanner:
         while self.column == indent and self.peek() != '\0':
             chunks.extend(breaks)
             leading_non_space = self.peek() not in ' \t'
-            length = 0
-            while self.peek(length) not in '\0\r\n\x85\u2028\u2029':
-                length += 1
+            length = self.match_length(self.LINE)
             chunks.append(self.prefix(length))
             self.forward(length)
             line_break = self.scan_line_break()
@@ -1094,8 +1109,7 @@ class Scanner:
         while self.peek() == ' ':
             self.forward()
         if self.peek() == '#':
-            while self.peek() not in '\0\r\n\x85\u2028\u2029':
-                self.forward()
+            self.forward(self.match_length(self.LINE))
         ch = self.peek()
         if ch not in '\0\r\n\x85\u2028\u2029':
             raise ScannerError("while scanning a block scalar", start_mark,
@@ -1186,9 +1200,7 @@ class Scanner:
         # See the specification for details.
         chunks = []
         while True:
-            length = 0
-            while self.peek(length) not in '\'\"\\\0 \t\r\n\x85\u2028\u2029':
-                length += 1
+            length = self.match_length(self.QUOTED)
             if length:
                 chunks.append(self.prefix(length))
                 self.forward(length)
@@ -1283,18 +1295,10 @@ class Scanner:
         #    indent = 1
         spaces = []
         while True:
-            length = 0
             if self.peek() == '#':
                 break
-            while True:
-                ch = self.peek(length)
-                if ch in '\0 \t\r\n\x85\u2028\u2029'    \
-                        or (ch == ':' and
-                                self.peek(length+1) in '\0 \t\r\n\x85\u2028\u2029'
-                                      + (u',[]{}' if self.flow_level else u''))\
-                        or (self.flow_level and ch in ',?[]{}'):
-                    break
-                length += 1
+            length = self.match_length(self.PLAIN_FLOW if self.flow_level
+                    else self.PLAIN_BLOCK)
             if length == 0:
                 break
             self.allow_simple_key = False
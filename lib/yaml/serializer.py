@@ -12,6 +12,12 @@ class Serializer:
 
     ANCHOR_TEMPLATE = 'id%03d'
 
+    # Objects which occur more than once in a document are written once with
+    # an anchor and then as aliases. A dumper with `aliases = False` declares
+    # its data shares no objects and skips looking for them, shared objects
+    # are then written out in full every time (and recursive ones never end).
+    aliases = True
+
     def __init__(self, encoding=None,
             explicit_start=None, explicit_end=None, version=None, tags=None):
         self.use_encoding = encoding
@@ -50,7 +56,8 @@ class Serializer:
             raise SerializerError("serializer is closed")
         self.emit(DocumentStartEvent(explicit=self.use_explicit_start,
             version=self.use_version, tags=self.use_tags))
-        self.anchor_node(node)
+        if self.aliases:
+            self.anchor_node(node)
         self.serialize_node(node, None, None)
         self.emit(DocumentEndEvent(explicit=self.use_explicit_end))
         self.serialized_nodes = {}
@@ -76,11 +83,13 @@ class Serializer:
         return self.ANCHOR_TEMPLATE % self.last_anchor_id
 
     def serialize_node(self, node, parent, index):
-        alias = self.anchors[node]
-        if node in self.serialized_nodes:
+        alias = self.anchors[node] if self.aliases else None
+        if alias is not None and node in self.serialized_nodes:
             self.emit(AliasEvent(alias))
         else:
-            self.serialized_nodes[node] = True
+            # Only nodes with an anchor can be met again
+            if alias is not None:
+                self.serialized_nodes[node] = True
             self.descend_resolver(parent, index)
             if isinstance(node, ScalarNode):
                 detected_tag = self.resolve(ScalarNode, node.value, (True, False))
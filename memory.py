@@ -0,0 +1,116 @@
+import sys
+import logging
+import resource
+import threading
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# tracemalloc is process wide, so only one transfer at a time can have its allocations traced
+_lock = threading.Lock()
+
+
+def current_rss():
+    # Resident set size of this process in bytes. Without /proc (e.g. on macOS) this falls back to the peak RSS of the
+    # process, which is still an upper bound.
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class MemoryTracker(object):
+    # Tracks the memory high-water mark of a transfer. A background thread samples the RSS of the process, and
+    # unless trace is False, tracemalloc measures the peak of the memory allocated by Python and which lines
+    # allocated the most of what was still held at the end. Tracing makes the transfer several times slower. If it is
+    # not enabled it does nothing at all.
+    def __init__(self, trace=True, interval=0.01, top=10, enabled=True):
+        self.enabled = enabled
+        self.trace = trace
+        self.interval = interval
+        self.top = top
+        self.rss_start = None
+        self.rss_peak = None
+        self.traced_peak = None
+        self.allocations = []
+        self._tracing = False
+        self._started_tracing = False
+        self._snapshot = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+
+        self.rss_start = self.rss_peak = current_rss()
+
+        if self.trace:
+            self._tracing = _lock.acquire(blocking=False)
+            if not self._tracing:
+                logger.warning("Another transfer is tracing its memory, only sampling the RSS of this one")
+            else:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self._started_tracing = True
+                if hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+                self._snapshot = tracemalloc.take_snapshot()
+
+        self._thread = threading.Thread(target=self._sample, name='memory-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.enabled:
+            return
+
+        self._stop.set()
+        self._thread.join()
+        self.rss_peak = max(self.rss_peak, current_rss())
+
+        if self._tracing:
+            try:
+                self.traced_peak = tracemalloc.get_traced_memory()[1]
+                snapshot = tracemalloc.take_snapshot()
+                for stat in snapshot.compare_to(self._snapshot, 'lineno')[:self.top]:
+                    frame = stat.traceback[0]
+                    self.allocations.append({
+                        'line': '{}:{}'.format(frame.filename, frame.lineno),
+                        'size_diff': stat.size_diff,
+                        'count_diff': stat.count_diff,
+                    })
+                self._snapshot = None
+                if self._started_tracing:
+                    tracemalloc.stop()
+            finally:
+                _lock.release()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            if rss > self.rss_peak:
+                self.rss_peak = rss
+
+    def report(self):
+        report = {
+            'rss_start': self.rss_start,
+            'rss_peak': self.rss_peak,
+            'rss_growth': self.rss_peak - self.rss_start,
+        }
+        if self.traced_peak is not None:
+            report['traced_peak'] = self.traced_peak
+            report['allocations'] = self.allocations
+        return report
+
+    def summary(self):
+        summary = "Peak RSS {:.1f} MiB ({:+.1f} MiB)".format(self.rss_peak / 2.0 ** 20, (self.rss_peak - self.rss_start) / 2.0 ** 20)
+        if self.traced_peak is not None:
+            summary += ", peak traced allocations {:.1f} MiB".format(self.traced_peak / 2.0 ** 20)
+            for allocation in self.allocations:
+                summary += "\n{:>+12.1f} KiB {:>+8}  {}".format(allocation['size_diff'] / 1024.0, allocation['count_diff'], allocation['line'])
+        return summary
@@ -0,0 +1,126 @@
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric(object):
+    # A family of samples kept in process-local memory, one per combination of label values. Updates only take an
+    # uncontended lock and a dict lookup, so they are cheap enough to make once per challenge.
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.extend(self._samples(labels, value))
+        return lines
+
+    def _samples(self, labels, value):
+        return ['{}{} {}'.format(self.name, _format_labels(self.labels, labels), _format_value(value))]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts, total = self._values.get(labels, (None, 0.0))
+            if counts is None:
+                counts = [0] * len(self.buckets)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[labels] = (counts, total + value)
+
+    def _samples(self, labels, value):
+        counts, total = value
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            samples.append('{}_bucket{} {}'.format(self.name, _format_labels(self.labels, labels, [('le', _format_value(bound))]), cumulative))
+        samples.append('{}_sum{} {}'.format(self.name, _format_labels(self.labels, labels), _format_value(total)))
+        samples.append('{}_count{} {}'.format(self.name, _format_labels(self.labels, labels), cumulative))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), **kwargs):
+        return self._register(Histogram(name, help, labels, **kwargs))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+TRANSFER_DURATION = REGISTRY.histogram('ctfd_portable_transfer_duration_seconds', 'Time taken by transfers through /admin/yaml', ['kind'])
+TRANSFER_BYTES = REGISTRY.counter('ctfd_portable_transfer_bytes_total', 'Bytes of archives uploaded to (in) and downloaded from (out) /admin/yaml', ['direction'])
+TRANSFER_FAILURES = REGISTRY.counter('ctfd_portable_transfer_failures_total', 'Transfers through /admin/yaml which failed', ['kind'])
+ACTIVE_JOBS = REGISTRY.gauge('ctfd_portable_active_jobs', 'Transfers through /admin/yaml in progress', ['kind'])
+CHALLENGES = REGISTRY.counter('ctfd_portable_challenges_total', 'Challenges processed by exports and imports, by outcome', ['kind', 'result'])
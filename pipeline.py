@@ -0,0 +1,74 @@
+import queue
+import threading
+
+try:
+    from .timing import current_timer, use_timer
+    from .profiling import profiling
+except ImportError:
+    from timing import current_timer, use_timer
+    from profiling import profiling
+
+# Put into a stage's queue after the last item
+_DONE = object()
+
+
+class Stage(object):
+    # Calls function on every item put into it, in order, in a thread of its own, so a transfer can e.g. write
+    # attachments while it goes on serializing challenges. The queue in front of the thread is bounded, so a stage
+    # which falls behind makes put() wait rather than piling up items in memory. The phases function times count
+    # towards the timer of the thread which created the stage. If function raises, the items after it are dropped and
+    # the error is raised again by put() and join(). While the transfer is being profiled function is called by put()
+    # itself instead, so the profile sees it.
+    def __init__(self, name, function, depth=64):
+        self.name = name
+        self.function = function
+        self.results = []
+        self.error = None
+        self.inline = profiling()
+        self._cancelled = False
+        self._queue = queue.Queue(maxsize=depth)
+        self._timer = current_timer()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        if not self.inline:
+            self._thread.start()
+
+    def _run(self):
+        with use_timer(self._timer):
+            while True:
+                item = self._queue.get()
+                if item is _DONE:
+                    return
+                if self.error is None and not self._cancelled:
+                    try:
+                        self.results.append(self.function(item))
+                    except Exception as e:
+                        self.error = e
+
+    def put(self, item):
+        if self.inline:
+            self.results.append(self.function(item))
+            return
+        if self.error is not None:
+            raise self.error
+        self._queue.put(item)
+
+    def join(self):
+        # Waits for every item put so far to be processed and returns the results in order
+        if self._thread.is_alive():
+            self._queue.put(_DONE)
+            self._thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # If the caller failed, the items still queued are dropped
+        if exc_type is not None:
+            self._cancelled = True
+        if self._thread.is_alive():
+            self._queue.put(_DONE)
+            self._thread.join()
@@ -1,33 +1,43 @@
-from flask import Blueprint, send_file, request, abort, render_template_string
+from flask import Blueprint, send_file, request, abort, render_template_string, jsonify, make_response
 from werkzeug.utils import secure_filename
 from .exporter import export_challenges
-from .importer import import_challenges
+from .importer import import_challenges, plan_import
+from .timing import TransferTimer, phase
+from .querycounter import QueryCounter
+from .profiling import TransferProfiler
+from .jobs import JobRegistry
+from .memory import MemoryTracker
+from . import yamlbackend
+from .metrics import REGISTRY, CONTENT_TYPE, TRANSFER_DURATION, TRANSFER_BYTES, TRANSFER_FAILURES, ACTIVE_JOBS
 from tempfile import TemporaryFile, mkdtemp
 from gzip import GzipFile
 from CTFd.utils.decorators import admins_only
+from CTFd.models import db
 import tarfile
 import gzip
 import os
 import shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+PROFILE_FILE = 'profile.prof'
 
 
 def load(app):
     portable = Blueprint('portable', __name__)
+    jobs = JobRegistry()
 
-    @portable.route('/admin/yaml', methods=['GET', 'POST'])
-    @admins_only
-    def transfer_yaml():
-        print(" * Transferring yml")
-        upload_folder = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
-        if request.method == 'GET':
-            tarfile_backend = TemporaryFile(mode='wb+')
-            yamlfile = TemporaryFile(mode='wb+')
-            tarball = tarfile.open(fileobj=tarfile_backend, mode='w')
-            visible_only = request.args.get('visibleOnly', default=False, type=bool)
-            remove_flags = request.args.get('removeFlags', default=False, type=bool)
+    def export_yaml(upload_folder):
+        tarfile_backend = TemporaryFile(mode='wb+')
+        yamlfile = TemporaryFile(mode='wb+')
+        tarball = tarfile.open(fileobj=tarfile_backend, mode='w')
+        visible_only = request.args.get('visibleOnly', default=False, type=bool)
+        remove_flags = request.args.get('removeFlags', default=False, type=bool)
 
-            yamlfile.write(bytes(export_challenges(out_file='export.yaml', dst_attachments='export.d', src_attachments=upload_folder, visible_only=visible_only, remove_flags=remove_flags, tarfile=tarball), "UTF-8"))
+        yamlfile.write(bytes(export_challenges(out_file='export.yaml', dst_attachments='export.d', src_attachments=upload_folder, visible_only=visible_only, remove_flags=remove_flags, tarfile=tarball), "UTF-8"))
 
+        with phase('copy'):
             tarinfo = tarfile.TarInfo('export.yaml')
             tarinfo.size = yamlfile.tell()
             yamlfile.seek(0)
@@ -35,6 +45,7 @@ def load(app):
             tarball.close()
             yamlfile.close()
 
+        with phase('compress'):
             gzipfile_backend = TemporaryFile(mode='wb+')
             gzipfile = GzipFile(fileobj=gzipfile_backend, mode='wb')
 
@@ -43,23 +54,26 @@ def load(app):
 
             tarfile_backend.close()
             gzipfile.close()
+            TRANSFER_BYTES.inc('out', amount=gzipfile_backend.tell())
             gzipfile_backend.seek(0)
-            return send_file(gzipfile_backend, as_attachment=True, attachment_filename='export.tar.gz')
+        return send_file(gzipfile_backend, as_attachment=True, attachment_filename='export.tar.gz')
 
-        if request.method == 'POST':
-            if 'file' not in request.files:
-                abort(400)
+    def import_yaml(upload_folder):
+        if 'file' not in request.files:
+            abort(400)
 
-            file = request.files['file']
+        file = request.files['file']
+        TRANSFER_BYTES.inc('in', amount=request.content_length or 0)
 
-            readmode = 'r:gz'
-            if file.filename.endswith('.tar'):
-                readmode = 'r'
-            if file.filename.endswith('.bz2'):
-                readmode = 'r:bz2'
+        readmode = 'r:gz'
+        if file.filename.endswith('.tar'):
+            readmode = 'r'
+        if file.filename.endswith('.bz2'):
+            readmode = 'r:bz2'
 
-            tempdir = mkdtemp()
-            try:
+        tempdir = mkdtemp()
+        try:
+            with phase('copy'):
                 archive = tarfile.open(fileobj=file.stream, mode=readmode)
 
                 if 'export.yaml' not in archive.getnames():
@@ -81,17 +95,93 @@ def load(app):
 
                 archive.extractall(path=tempdir)
 
-            except tarfile.TarError:
+        except tarfile.TarError:
+            shutil.rmtree(tempdir)
+            abort(400)
+
+        content_addressed = request.args.get('contentAddressed', default=False, type=bool)
+        plan = request.args.get('plan', default=False, type=bool)
+        sync = request.args.get('sync', default=False, type=bool)
+
+        in_file = os.path.join(tempdir, 'export.yaml')
+        if plan:
+            try:
+                return jsonify(plan_import(in_file, upload_folder, content_addressed=content_addressed, sync=sync))
+            finally:
                 shutil.rmtree(tempdir)
-                print('b')
-                abort(400)
 
-            in_file = os.path.join(tempdir, 'export.yaml')
-            import_challenges(in_file, upload_folder, move=True)
+        import_challenges(in_file, upload_folder, move=True, content_addressed=content_addressed, sync=sync)
 
-            shutil.rmtree(tempdir)
+        shutil.rmtree(tempdir)
+
+        return '1'
 
-            return '1'
+    @portable.route('/admin/yaml', methods=['GET', 'POST'])
+    @admins_only
+    def transfer_yaml():
+        logger.info("Transferring yml")
+        upload_folder = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
+
+        job = jobs.start('export' if request.method == 'GET' else 'import', yaml_backend=yamlbackend.BACKEND)
+        profile = request.args.get('profile', default=False, type=bool)
+        profiler = TransferProfiler(os.path.join(jobs.directory(job), PROFILE_FILE) if profile else None, enabled=profile)
+        tracker = MemoryTracker(enabled=request.args.get('memory', default=False, type=bool))
+
+        ACTIVE_JOBS.inc(job['kind'])
+        try:
+            with TransferTimer(job['kind'].capitalize()) as timer, QueryCounter(db.engine) as counter, profiler, tracker:
+                if request.method == 'GET':
+                    response = make_response(export_yaml(upload_folder))
+                else:
+                    response = make_response(import_yaml(upload_folder))
+        except Exception:
+            jobs.finish(job, status='failed')
+            TRANSFER_FAILURES.inc(job['kind'])
+            raise
+        finally:
+            ACTIVE_JOBS.dec(job['kind'])
+        TRANSFER_DURATION.observe(timer.elapsed, job['kind'])
+        logger.info(timer.summary())
+        logger.info(counter.summary())
+
+        jobs.finish(job, elapsed=timer.elapsed, phases=timer.totals, statements=counter.statements, db_time=counter.time)
+        if profiler.active:
+            jobs.finish(job, profile=profiler.top())
+        if tracker.enabled:
+            jobs.finish(job, memory=tracker.report())
+
+        response.headers['X-Transfer-Job'] = job['id']
+        if request.args.get('timing', default=False, type=bool):
+            response.headers['Server-Timing'] = ', '.join([timer.server_timing(), counter.server_timing()])
+        return response
+
+    @portable.route('/admin/yaml/metrics', methods=['GET'])
+    @admins_only
+    def transfer_metrics():
+        response = make_response(REGISTRY.render())
+        response.headers['Content-Type'] = CONTENT_TYPE
+        return response
+
+    @portable.route('/admin/yaml/jobs', methods=['GET'])
+    @admins_only
+    def transfer_jobs():
+        return jsonify(jobs.list())
+
+    @portable.route('/admin/yaml/jobs/<job_id>', methods=['GET'])
+    @admins_only
+    def transfer_job(job_id):
+        job = jobs.get(job_id)
+        if job is None:
+            abort(404)
+        return jsonify(job)
+
+    @portable.route('/admin/yaml/jobs/<job_id>/profile', methods=['GET'])
+    @admins_only
+    def transfer_job_profile(job_id):
+        path = jobs.file(job_id, PROFILE_FILE)
+        if path is None:
+            abort(404)
+        return send_file(path, as_attachment=True, attachment_filename='{}.prof'.format(job_id))
 
     @portable.route('/admin/transfer', methods=['GET'])
     @admins_only
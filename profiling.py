@@ -0,0 +1,75 @@
+import cProfile
+import pstats
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Only one profiler can be active in a process on recent Pythons, so concurrent transfers are not all profiled
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class TransferProfiler(object):
+    # Runs a transfer under cProfile and optionally dumps the stats to a file which can be opened with pstats or
+    # snakeviz. If it is not enabled, or another transfer is already being profiled, the transfer runs unprofiled and
+    # active is False.
+    def __init__(self, stats_file=None, enabled=True):
+        self.stats_file = stats_file
+        self.enabled = enabled
+        self.profile = None
+        self.active = False
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+
+        self.active = _lock.acquire(blocking=False)
+        if not self.active:
+            logger.warning("Another transfer is being profiled, not profiling this one")
+            return self
+
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        _local.profiler = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.active:
+            return
+        _local.profiler = None
+        try:
+            self.profile.disable()
+            if self.stats_file:
+                self.profile.dump_stats(self.stats_file)
+        finally:
+            _lock.release()
+
+    def top(self, limit=20):
+        # The functions with the most cumulative time, i.e. including the time spent in the functions they call
+        if self.profile is None:
+            return []
+
+        stats = pstats.Stats(self.profile).stats
+        functions = []
+        for (filename, line, name), (primitive_calls, calls, total, cumulative, callers) in stats.items():
+            functions.append({
+                'function': '{}:{}({})'.format(filename, line, name),
+                'calls': calls,
+                'total_time': total,
+                'cumulative_time': cumulative,
+            })
+        functions.sort(key=lambda function: function['cumulative_time'], reverse=True)
+        return functions[:limit]
+
+    def summary(self, limit=20):
+        lines = ["{:>10} {:>10} {:>10}  {}".format('calls', 'tottime', 'cumtime', 'function')]
+        for function in self.top(limit):
+            lines.append("{calls:>10} {total_time:>10.3f} {cumulative_time:>10.3f}  {function}".format(**function))
+        return '\n'.join(lines)
+
+
+def profiling():
+    # Whether the transfer running on this thread is being profiled. cProfile only sees the thread which enabled it on
+    # most Pythons, so work a transfer would hand to other threads has to stay on this one to show up in the profile.
+    return getattr(_local, 'profiler', None) is not None
@@ -0,0 +1,52 @@
+import time
+import threading
+from sqlalchemy import event
+
+
+class QueryCounter(object):
+    # Counts the SQL statements issued on an engine by the current thread while it is active, along with the time
+    # the database took to execute them. Other threads sharing the engine (e.g. other requests) are not counted.
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = 0
+        self.time = 0.0
+        self.kinds = {}
+        self._thread = None
+        self._started = []
+
+    def __enter__(self):
+        self._thread = threading.get_ident()
+        event.listen(self.engine, 'before_cursor_execute', self._before)
+        event.listen(self.engine, 'after_cursor_execute', self._after)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self.engine, 'before_cursor_execute', self._before)
+        event.remove(self.engine, 'after_cursor_execute', self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() != self._thread:
+            return
+        self.statements += 1
+        kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+        self.kinds[kind] = self.kinds.get(kind, 0) + 1
+        self._started.append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() != self._thread or not self._started:
+            return
+        self.time += time.perf_counter() - self._started.pop()
+
+    def report(self):
+        return {
+            'statements': self.statements,
+            'time': self.time,
+            'kinds': dict(self.kinds),
+        }
+
+    def summary(self):
+        kinds = ', '.join('{} {}'.format(count, kind) for kind, count in sorted(self.kinds.items()))
+        return "{} SQL statements taking {:.3f}s ({})".format(self.statements, self.time, kinds or 'none')
+
+    def server_timing(self):
+        return 'db;dur={:.1f};desc="{} statements"'.format(self.time * 1000, self.statements)
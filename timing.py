@@ -0,0 +1,114 @@
+import time
+import threading
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+class TransferTimer(object):
+    # Accumulates the time a transfer spends in each phase (query, serialize, parse, hash, copy, compress, commit).
+    # Phases may nest, the time spent in an inner phase is not counted towards the outer one, so the totals of a
+    # single thread add up to at most the wall time of the transfer. Threads which run part of the transfer (see
+    # use_timer) keep their own stack of phases, so the totals of a pipelined transfer can add up to more.
+    def __init__(self, name):
+        self.name = name
+        self.totals = {}
+        self.start = None
+        self.end = None
+        self._lock = threading.Lock()
+        self._threads = threading.local()
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = getattr(_local, 'timer', None)
+        _local.timer = self
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time.perf_counter()
+        _local.timer = self._previous
+
+    @property
+    def elapsed(self):
+        if self.start is None:
+            return 0.0
+        return (self.end or time.perf_counter()) - self.start
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        stack = self._threads.__dict__.setdefault('stack', [])
+        now = time.perf_counter()
+        if stack:
+            outer, resumed = stack[-1]
+            self.add(outer, now - resumed)
+        stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            name, resumed = stack.pop()
+            self.add(name, now - resumed)
+            if stack:
+                stack[-1][1] = now
+
+    def report(self):
+        with self._lock:
+            phases = dict(self.totals)
+        return {
+            'name': self.name,
+            'elapsed': self.elapsed,
+            'phases': phases,
+        }
+
+    def summary(self):
+        phases = ', '.join('{} {:.3f}s'.format(name, seconds) for name, seconds in self.report()['phases'].items())
+        return "{} finished in {:.3f}s ({})".format(self.name, self.elapsed, phases or 'no phases recorded')
+
+    def server_timing(self):
+        # Value for a Server-Timing response header, durations are in milliseconds
+        metrics = ['{};dur={:.1f}'.format(name, seconds * 1000) for name, seconds in self.report()['phases'].items()]
+        metrics.append('total;dur={:.1f}'.format(self.elapsed * 1000))
+        return ', '.join(metrics)
+
+
+def current_timer():
+    return getattr(_local, 'timer', None)
+
+
+@contextmanager
+def use_timer(timer):
+    # Counts the phases of this thread towards timer, e.g. in a thread which a transfer hands part of its work to
+    previous = getattr(_local, 'timer', None)
+    _local.timer = timer
+    try:
+        yield timer
+    finally:
+        _local.timer = previous
+
+
+@contextmanager
+def phase(name):
+    # Times a phase of whichever transfer is running on this thread, or does nothing if there is none
+    timer = current_timer()
+    if timer is None:
+        yield
+    else:
+        with timer.phase(name):
+            yield
+
+
+def timed(name, iterable):
+    # Attributes the time spent producing each item of a lazy iterable (e.g. a YAML parser) to a phase
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
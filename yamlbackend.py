@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import logging
+import argparse
+
+# Try to load PyYAMP if it's installed, if not load the local version
+try:
+    import yaml
+    VENDORED = False
+except ModuleNotFoundError:
+    try:
+        from .lib import yaml
+    except ImportError:
+        from lib import yaml
+    VENDORED = True
+
+logger = logging.getLogger(__name__)
+
+DUMP_OPTIONS = {'default_flow_style': False, 'allow_unicode': True, 'explicit_start': True, 'sort_keys': False}
+
+# Challenges covering the scalars an export runs into: multi-line and indented text, quotes, YAML syntax and values
+# which only stay strings when quoted, long lines which get folded, non-ASCII and non-printable characters.
+SAMPLE = [
+    {
+        'name': 'Sample',
+        'value': 100,
+        'description': 'First line\nSecond line with a trailing space \n\n    indented code\n\ttab\r\nwindows line',
+        'category': 'Web: "quotes" & \'apostrophes\'',
+        'type': 'standard',
+        'flags': [{'flag': 'flag{sample}', 'type': 'static', 'data': ''}, {'flag': '^flag\\{[a-z]+\\}$', 'type': 'regex', 'data': 'case_insensitive'}],
+        'hints': [{'hint': '- looks like a list item', 'type': 'standard', 'cost': 0}],
+        'hidden': False,
+        'max_attempts': 3,
+        'tags': ['yes', 'null', '~', '1.0', '0x1A', '2020-01-01', '', ' padded ', '#comment', '*alias', '&anchor', '!tag', '%directive', '@', '`'],
+        'files': ['export.d/0123456789abcdef/file name.tar.gz'],
+        'requirements': ['Other: challenge'],
+    },
+    {
+        'name': 'Ünïcödé 中文 😀',
+        'value': 0,
+        'description': ' '.join(['word'] * 40) + '\n' + 'x' * 120 + ' ' + '"' * 3 + ' ' + 'é' * 90 + ' \x85\x07\ufeff',
+        'category': '',
+        'type': 'dynamic',
+        'flags': [],
+        'hints': [],
+        'hidden': True,
+        'initial': 500,
+        'decay': 10,
+        'minimum': 50,
+    },
+]
+
+
+def check_parity(documents, loader, dumper):
+    # Returns the problems found when the given backend is used in place of the pure Python one on the documents,
+    # which is empty if both load the same data from the same text and the output of both loads as the same data.
+    # libyaml folds long double quoted scalars at different points, so the text itself is allowed to differ.
+    problems = []
+    for index, document in enumerate(documents):
+        text = yaml.dump(document, Dumper=yaml.SafeDumper, **DUMP_OPTIONS)
+        if yaml.load(text, Loader=loader) != yaml.load(text, Loader=yaml.SafeLoader):
+            problems.append("document {} loads differently".format(index))
+        other = yaml.dump(document, Dumper=dumper, **DUMP_OPTIONS)
+        if yaml.load(other, Loader=yaml.SafeLoader) != yaml.load(text, Loader=yaml.SafeLoader):
+            problems.append("document {} dumps differently".format(index))
+    return problems
+
+
+def alias_free(dumper):
+    # Dumpers of the vendored PyYAML can be told the data shares no objects, so they don't look for any to write as
+    # aliases (see Serializer.aliases). Exported challenges never share any.
+    if getattr(dumper, 'aliases', None) is not True:
+        return dumper
+    return type(dumper.__name__, (dumper,), {'aliases': False})
+
+
+def select_backend(preferred=None):
+    # libyaml is used if PyYAML was built with it and agrees with the pure Python backend on the sample, unless
+    # CTFD_PORTABLE_YAML=python asks for the pure Python one
+    preferred = preferred or os.environ.get('CTFD_PORTABLE_YAML', 'fast')
+    if preferred != 'python' and getattr(yaml, '__with_libyaml__', False):
+        problems = check_parity(SAMPLE, yaml.CSafeLoader, yaml.CSafeDumper)
+        if not problems:
+            return 'libyaml', yaml.CSafeLoader, yaml.CSafeDumper
+        logger.warning("Not using libyaml, it disagrees with the pure Python YAML backend: %s", ', '.join(problems))
+    return 'python', yaml.SafeLoader, alias_free(yaml.SafeDumper)
+
+
+BACKEND, Loader, Dumper = select_backend()
+
+
+def describe():
+    return "{} (PyYAML {}{})".format(BACKEND, yaml.__version__, ', vendored' if VENDORED else '')
+
+
+def load_all(stream):
+    return yaml.load_all(stream, Loader=Loader)
+
+
+def dump(data):
+    return yaml.dump(data, Dumper=Dumper, **DUMP_OPTIONS)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Report the YAML backend the exporter and importer use and check it and the fast challenge writer agree with the pure Python backend')
+    parser.add_argument('files', type=str, nargs='*', help="exported YAML files to check along with the built in sample")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    try:
+        from . import fastyaml
+    except ImportError:
+        import fastyaml
+
+    print("YAML backend: {}".format(fastyaml.describe()))
+
+    documents = list(SAMPLE)
+    for path in args.files:
+        with open(path, 'r') as in_stream:
+            documents.extend(yaml.load_all(in_stream, Loader=yaml.SafeLoader))
+
+    problems = []
+    if BACKEND != 'python':
+        problems = check_parity(documents, Loader, Dumper)
+        identical = sum(1 for document in documents if yaml.dump(document, Dumper=yaml.SafeDumper, **DUMP_OPTIONS) == dump(document))
+        print("{} documents checked, {} dumped to identical text by {}".format(len(documents), identical, BACKEND))
+    if fastyaml.ENABLED:
+        problems.extend("document {} is written differently by the fast challenge writer".format(index) for index in fastyaml.check(documents))
+    print("{} problems".format(len(problems)))
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(1)